@@ -10,12 +10,20 @@ import time
 import tftpy
 import struct
 import os
+import io
 from ping3 import ping
 import logging
 import numpy as np
 from datetime import datetime
 import time
 import netifaces
+import functools
+import copy
+import contextlib
+import ctypes
+import select
+import errno
+import sys
 
 # The LSBParams describes the map of the code ids to the real settings.
 # All of the info is from the PANOSETI wiki:
@@ -104,7 +112,7 @@ HKPktDef = {
     'tag': {
         'offset': 0,
         'length': 1,
-        'type': 'byte'   
+        'type': 'ubyte'
     },
     'boardloc': {
         'offset': 2,
@@ -325,6 +333,67 @@ DaqPktDef = {
     }
 }
 
+# The MarocRegDef describes the bit fields in the MAROC slow control register.
+# The key is the tag in the quabo config, and the value is the lsb position, the field width
+# and the width used for reversing the bits(0 means the bits are not reversed).
+# MASKOR1_xx, MASKOR2_xx, CTEST_xx and GAINxx are per-channel tags, which are listed in MarocChanRegDef.
+MarocRegDef = {
+    'OTABG_ON': {'lsb': 0, 'width': 1, 'reverse': 0},
+    'DAC_ON': {'lsb': 1, 'width': 1, 'reverse': 0},
+    'SMALL_DAC': {'lsb': 2, 'width': 1, 'reverse': 0},
+    'DAC2': {'lsb': 3, 'width': 10, 'reverse': 10},
+    'DAC1': {'lsb': 13, 'width': 10, 'reverse': 10},
+    'ENB_OUT_ADC': {'lsb': 23, 'width': 1, 'reverse': 0},
+    'INV_START_GRAY': {'lsb': 24, 'width': 1, 'reverse': 0},
+    'RAMP8B': {'lsb': 25, 'width': 1, 'reverse': 0},
+    'RAMP10B': {'lsb': 26, 'width': 1, 'reverse': 0},
+    'CMD_CK_MUX': {'lsb': 155, 'width': 1, 'reverse': 0},
+    'D1_D2': {'lsb': 156, 'width': 1, 'reverse': 0},
+    'INV_DISCR_ADC': {'lsb': 157, 'width': 1, 'reverse': 0},
+    'POLAR_DISCRI': {'lsb': 158, 'width': 1, 'reverse': 0},
+    'ENB3ST': {'lsb': 159, 'width': 1, 'reverse': 0},
+    'VAL_DC_FSB2': {'lsb': 160, 'width': 1, 'reverse': 0},
+    'SW_FSB2_50F': {'lsb': 161, 'width': 1, 'reverse': 0},
+    'SW_FSB2_100F': {'lsb': 162, 'width': 1, 'reverse': 0},
+    'SW_FSB2_100K': {'lsb': 163, 'width': 1, 'reverse': 0},
+    'SW_FSB2_50K': {'lsb': 164, 'width': 1, 'reverse': 0},
+    'VALID_DC_FS': {'lsb': 165, 'width': 1, 'reverse': 0},
+    'CMD_FSB_FSU': {'lsb': 166, 'width': 1, 'reverse': 0},
+    'SW_FSB1_50F': {'lsb': 167, 'width': 1, 'reverse': 0},
+    'SW_FSB1_100F': {'lsb': 168, 'width': 1, 'reverse': 0},
+    'SW_FSB1_100K': {'lsb': 169, 'width': 1, 'reverse': 0},
+    'SW_FSB1_50k': {'lsb': 170, 'width': 1, 'reverse': 0},
+    'SW_FSU_100K': {'lsb': 171, 'width': 1, 'reverse': 0},
+    'SW_FSU_50K': {'lsb': 172, 'width': 1, 'reverse': 0},
+    'SW_FSU_25K': {'lsb': 173, 'width': 1, 'reverse': 0},
+    'SW_FSU_40F': {'lsb': 174, 'width': 1, 'reverse': 0},
+    'SW_FSU_20F': {'lsb': 175, 'width': 1, 'reverse': 0},
+    'H1H2_CHOICE': {'lsb': 176, 'width': 1, 'reverse': 0},
+    'EN_ADC': {'lsb': 177, 'width': 1, 'reverse': 0},
+    'SW_SS_1200F': {'lsb': 178, 'width': 1, 'reverse': 0},
+    'SW_SS_600F': {'lsb': 179, 'width': 1, 'reverse': 0},
+    'SW_SS_300F': {'lsb': 180, 'width': 1, 'reverse': 0},
+    'ON_OFF_SS': {'lsb': 181, 'width': 1, 'reverse': 0},
+    'SWB_BUF_2P': {'lsb': 182, 'width': 1, 'reverse': 0},
+    'SWB_BUF_1P': {'lsb': 183, 'width': 1, 'reverse': 0},
+    'SWB_BUF_500F': {'lsb': 184, 'width': 1, 'reverse': 0},
+    'SWB_BUF_250F': {'lsb': 185, 'width': 1, 'reverse': 0},
+    'CMD_FSB': {'lsb': 186, 'width': 1, 'reverse': 0},
+    'CMD_SS': {'lsb': 187, 'width': 1, 'reverse': 0},
+    'CMD_FSU': {'lsb': 188, 'width': 1, 'reverse': 0}
+}
+
+# The per-channel tags(chan is in range 0-63) are expanded here once, in the same format as MarocRegDef.
+# MASKOR1, MASKOR2 and CTEST have a quad of values, one for each chip;
+# the bits of GAIN need to be reversed.
+MarocChanRegDef = {}
+for _chan in range(64):
+    MarocChanRegDef['MASKOR1_%d'%_chan] = {'lsb': 154 - 2*_chan, 'width': 1, 'reverse': 0}
+    MarocChanRegDef['MASKOR2_%d'%_chan] = {'lsb': 153 - 2*_chan, 'width': 1, 'reverse': 0}
+    MarocChanRegDef['CTEST_%d'%_chan] = {'lsb': 828 - _chan, 'width': 1, 'reverse': 0}
+    MarocChanRegDef['GAIN%d'%_chan] = {'lsb': 757 - 9*_chan, 'width': 8, 'reverse': 8}
+del _chan
+
 class Util(object):
     """
     Description:
@@ -340,6 +409,11 @@ class Util(object):
         Outputs:
             - bytes(bytearray): the ip address bytes.
         """
+        # inet_pton only accepts the plain dotted-quad, the other forms(e.g. leading zeros) are parsed below
+        try:
+            return bytearray(socket.inet_pton(socket.AF_INET, ip_addr_str.strip()))
+        except OSError:
+            pass
         pieces = ip_addr_str.strip().split('.')
         if len(pieces) != 4:
             raise Exception('bad IP addr %s'%ip_addr_str)
@@ -362,6 +436,20 @@ class Util(object):
         Outputs:
             - data_out(int): the output data.
         """
+        # the 8-bit and 10-bit fields are looked up, only the low width bits are reversed
+        table = _REV_BITS.get(width)
+        if table is not None:
+            return table[data_in & ((1 << width) - 1)]
+        # the other widths up to 32 bits: reverse the 32-bit word by swapping the bits, pairs, nibbles,
+        # bytes and half words, and then shift the reversed low width bits down
+        if 0 <= width <= 32:
+            x = data_in & 0xffffffff
+            x = ((x >> 1) & 0x55555555) | ((x & 0x55555555) << 1)
+            x = ((x >> 2) & 0x33333333) | ((x & 0x33333333) << 2)
+            x = ((x >> 4) & 0x0f0f0f0f) | ((x & 0x0f0f0f0f) << 4)
+            x = ((x >> 8) & 0x00ff00ff) | ((x & 0x00ff00ff) << 8)
+            x = ((x >> 16) & 0xffff) | ((x & 0xffff) << 16)
+            return x >> (32 - width)
         data_out = 0
         for ii in range(width):
             data_out = data_out << 1
@@ -383,10 +471,16 @@ class Util(object):
             - bool: True if the ip is reachable, False otherwise.           
         """
         for i in range(loop):
+            start = time.monotonic()
             response_time = ping(ip, timeout=timeout)
-            if response_time is not None:
+            # ping3 returns None on timeout, and False on an error(e.g. the host is unreachable or unknown)
+            if response_time is not None and response_time is not False:
                 print(f"{ip} responded in {response_time * 1000:.2f} ms")
                 return True
+            if response_time is False:
+                # wait for the rest of the timeout, so the errors returned right away(e.g. while the quabo is
+                # rebooting) don't use up the attempts
+                time.sleep(max(0, timeout - (time.monotonic() - start)))
         print(f"{ip} is not reachable (timeout)")
         return False
     
@@ -469,9 +563,10 @@ class Util(object):
             - data(bytearray): the data received from the quabo.
             - timestamps(list): the timestamps of the data.
         Outputs:
-            - parsed_data(np.array): the parsed data.
+            - parsed_data(list): the parsed data, the same as DataRecv.ParseData. The lost packets are skipped.
         """
         parsed_data = []
+        parse = _sci_parser(mode)
         for i in range(len(pkt)):
             if pkt[i] is None:
                 continue
@@ -480,36 +575,9 @@ class Util(object):
             # parse the data here
             sci_data = {}
             sci_data['timestamp'] = timestamp
-            for k,v in DaqPktDef.items():
-                # deal with some special cases
-                if k == 'boardloc':
-                    r = struct.unpack('<H', data[0:2])[0]
-                    sci_data[k] = '192.168.%d.%d'%(r>>8, r&0xff)
-                    continue
-                if k == 'data':
-                    offset = v[mode]['offset']
-                    length = v[mode]['length']
-                    flag = DType[v[mode]['type']]['flag']
-                    size = DType[v[mode]['type']]['size']
-                    d = data[offset:offset+length]
-                    dtype = '<%d%s'%(length/size, flag)
-                    r = struct.unpack(dtype, d)
-                    if mode == 'ph':
-                        sci_data[k] = np.array(r, dtype=np.short)
-                    elif mode == 'movie-16bit':
-                        sci_data[k] = np.array(r, dtype=np.ushort)
-                    elif mode == 'movie-8bit':
-                        sci_data[k] = np.array(r, dtype=np.ubyte) 
-                    continue
-                offset = v['offset']
-                length = v['length']
-                flag = DType[v['type']]['flag']
-                size = DType[v['type']]['size']
-                d = data[offset:offset+length]
-                dtype = '<%d%s'%(length/size, flag)
-                sci_data[k] = struct.unpack(dtype, d)[0]
+            parse(data, sci_data)
             parsed_data.append(sci_data)
-        return np.array(parsed_data)
+        return parsed_data
     
     @staticmethod
     def ParseHKData(pkt, timestamps):
@@ -520,69 +588,542 @@ class Util(object):
             - pkt(bytearray): the data received from the quabo.
             - timestamps(list): the timestamps of the data.
         Outputs:
-            - parsed_data(np.array): the parsed housekeeping data.
-        """
-        parsed_data = np.zeros(len(pkt), dtype=object)
-        for i in range(len(pkt)):
-        # parse the housekeeping data here
+            - parsed_data(list): the parsed housekeeping data, the same as HKRecv.ParseData.
+                                 A lost packet is None.
+        """
+        parsed_data = [None]*len(pkt)
+        valid = [i for i in range(len(pkt)) if pkt[i] is not None]
+        if len(valid) == 0:
+            return parsed_data
+        for i, fields in zip(valid, _parse_hk_pkts([pkt[i] for i in valid])):
             hk_data = {}
             hk_data['timestamp'] = timestamps[i]
-            if pkt[i] is None:
-                continue
-            for k, v in HKPktDef.items():
-                offset = v['offset']
-                length = v['length']
-                flag = DType[v['type']]['flag']
-                size = DType[v['type']]['size']
-                dtype = '<%d%s'%(length/size, flag)
-                d = pkt[i][offset:offset+length]
-                # deal with some special cases
-                if k == 'uid' or k == 'fwtime':
-                    r = struct.unpack(dtype, d)[0]
-                    hk_data[k] = r
-                    continue
-                if k == 'fwver':
-                    r = struct.unpack(dtype, d)[0].decode('utf-8')[::-1]
-                    hk_data[k] = r
-                    continue
-                if k == 'boardloc':
-                    r = struct.unpack(dtype, d)[0]
-                    hk_data[k] = '192.168.%d.%d'%(r>>8, r&0xff)
-                    continue
-                # for other cases
-                # not all of the structs have lsb, constant, bit
-                try:
-                    lsb = v['lsb']
-                except:
-                    lsb = 1
-                try:
-                    constant = v['constant']
-                except:
-                    constant = 0
-                try:
-                    bit = v['bit']
-                except:
-                    bit = None
-                # start to parse hk data
-                if length == 1 and bit is None:
-                    hk_data[k] = pkt[i][offset]
-                elif length == 1 and bit is not None:
-                    hk_data[k] = (pkt[i][offset] >> bit) & 0x01
-                else:
-                    r = struct.unpack(dtype, d)[0]
-                    hk_data[k] = r * lsb + constant
+            hk_data.update(fields)
             parsed_data[i] = hk_data
         return parsed_data
-    
+
+# the resolved ip address bytes, {host: (bytes, expiry)}
+_resolve_cache = {}
+# how long a resolved hostname is kept, in seconds
+_RESOLVE_TTL = 300
+
+def _resolve_ipbytes(host):
+    """
+    Description:
+        resolve the hostname and convert the ip address to bytes.
+        The result is cached for _RESOLVE_TTL seconds, so the same destination is not resolved again
+        for each command, but a changed DNS record is still picked up.
+    Inputs:
+        - host(str): the ip address or hostname.
+    Outputs:
+        - bytes(bytes): the ip address bytes.
+    """
+    now = time.monotonic()
+    cached = _resolve_cache.get(host)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    ip_bytes = bytes(Util.ip_addr_str_to_bytes(socket.gethostbyname(host)))
+    _resolve_cache[host] = (ip_bytes, now + _RESOLVE_TTL)
+    return ip_bytes
+
+# the parsed quabo config files, {path: ((mtime, size), config)}
+_quabo_config_cache = {}
+
+def _load_quabo_config(path):
+    """
+    Description:
+        load the quabo config file.
+        The parsed config is cached with the mtime and size of the file, so the same file is not parsed again
+        for each QuaboConfig. Each caller gets its own copy, because the config is changed by QuaboConfig.
+    Inputs:
+        - path(str): the file path of the quabo config file.
+    Outputs:
+        - config(dict): the quabo config.
+    """
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _quabo_config_cache.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, 'rb') as f:
+            cached = (stamp, json.load(f))
+        _quabo_config_cache[path] = cached
+    # the sections only hold plain values, so copying them one level deep is enough(and faster than deepcopy)
+    return {k: dict(v) if isinstance(v, dict) and not any(isinstance(x, (dict, list)) for x in v.values())
+            else copy.deepcopy(v) for k, v in cached[1].items()}
+
+@functools.lru_cache(maxsize=512)
+def _boardloc_str(r):
+    """
+    Description:
+        convert the boardloc to an ip address string.
+        The result is cached, because the boardloc is the same for all the packets from a quabo.
+    Inputs:
+        - r(int): the boardloc in the packet.
+    Outputs:
+        - ip(str): the ip address string.
+    """
+    return '192.168.%d.%d'%(r>>8, r&0xff)
+
+# bit-reverse lookup tables used by Util.reverse_bits and the MAROC fields(DAC1, DAC2 and GAIN)
+_REV_BITS = {w: tuple(int(format(i, '0%db'%w)[::-1], 2) for i in range(1 << w)) for w in (8, 10)}
+_MAROC_REV = {w: np.array(t, dtype=np.uint16) for w, t in _REV_BITS.items()}
+
+def _pack_maroc_regs(lsb, width, vals, regs):
+    """
+    Description:
+        pack the MAROC bit fields into the registers of the 4 MAROC chips.
+        All of the fields are scattered bit by bit in a few numpy calls, 
+        so there is no python loop over the fields.
+    Inputs:
+        - lsb(np.ndarray): the lsb position of each field.
+        - width(np.ndarray): the width of each field.
+        - vals(np.ndarray): the values of each field, shape is (N, 4), one column for each chip.
+        - regs(np.ndarray): the registers of the 4 chips, shape is (4, 104), which are updated in place.
+    """
+    nbits = int(width.sum())
+    # the bit index inside each field, and the bit position in the register
+    bit = np.arange(nbits) - np.repeat(np.cumsum(width) - width, width)
+    pos = np.repeat(lsb, width) + bit
+    bits = (np.repeat(vals, width, axis=0) >> bit[:, None]) & 1
+    regbits = np.unpackbits(regs, axis=1, bitorder='little')
+    regbits[:, pos] = bits.T
+    regs[:] = np.packbits(regbits, axis=1, bitorder='little')
+
+# The kinds of the fields in the compiled packet definitions
+_PKT_RAW = 0        # the unpacked value is used directly, e.g. uid and fwtime
+_PKT_STRING = 1     # the bytes are decoded and reversed, e.g. fwver
+_PKT_BOARDLOC = 2   # the value is converted to an ip address string
+_PKT_BITS = 3       # the bits in the same byte, e.g. shutter_status and sensor_status
+_PKT_SCALED = 4     # the value is scaled by lsb and offset by constant
+
+def _compile_pkt_def(pkt_def):
+    """
+    Description:
+        compile a packet definition(HKPktDef or DaqPktDef), so the format strings, struct objects
+        and the optional lsb/constant/bit are only resolved once.
+        All the fields, except the bit fields, are unpacked by one struct, so a packet is unpacked in one call.
+    Inputs:
+        - pkt_def(dict): the packet definition. The fields must be in the order of their offsets.
+    Outputs:
+        - s(struct.Struct): the struct for all the fields.
+        - fields(tuple): (key, index, lsb, constant, bit, kind) for each field. The index is the
+                         index in the unpacked values. The bit fields in the same byte are grouped
+                         into one descriptor, whose index is the byte offset and bit is ((key, bit), ...).
+        - payload(dict): (offset, count, numpy dtype) for each mode of the data field, if there is one.
+    """
+    fmt = '<'
+    pos = 0
+    n = 0
+    fields = []
+    payload = {}
+    bit_groups = {}
+    for k, v in pkt_def.items():
+        # the data field in DaqPktDef has a definition for each mode
+        if 'offset' not in v:
+            for mode, d in v.items():
+                t = DType[d['type']]
+                payload[mode] = (d['offset'], d['length']//t['size'], np.dtype('<%s'%t['flag']))
+            continue
+        offset = v['offset']
+        length = v['length']
+        flag = DType[v['type']]['flag']
+        size = DType[v['type']]['size']
+        # not all of the structs have lsb, constant, bit
+        lsb = v.get('lsb', 1)
+        constant = v.get('constant', 0)
+        bit = v.get('bit', None)
+        if bit is not None:
+            if offset not in bit_groups:
+                bit_groups[offset] = []
+                fields.append((None, offset, lsb, constant, bit_groups[offset], _PKT_BITS))
+            bit_groups[offset].append((k, bit))
+            continue
+        if offset < pos:
+            raise ValueError('field %s overlaps the previous field'%k)
+        if offset > pos:
+            fmt += '%dx'%(offset - pos)
+        if flag == 's':
+            fmt += '%d%s'%(length, flag)
+        elif length == size:
+            fmt += flag
+        else:
+            raise ValueError('field %s is not a single value'%k)
+        pos = offset + length
+        if k == 'boardloc':
+            kind = _PKT_BOARDLOC
+        elif flag == 's':
+            kind = _PKT_STRING
+        elif 'lsb' in v or 'constant' in v:
+            kind = _PKT_SCALED
+        else:
+            kind = _PKT_RAW
+        fields.append((k, n, lsb, constant, bit, kind))
+        n += 1
+    fields = [(k, i, lsb, constant, tuple(bit) if kind == _PKT_BITS else bit, kind)
+              for k, i, lsb, constant, bit, kind in fields]
+    return struct.Struct(fmt), tuple(fields), payload
+
+_HK_STRUCT, _HK_FIELDS, _ = _compile_pkt_def(HKPktDef)
+
+def _compile_pkt_dtype(pkt_def, itemsize):
+    """
+    Description:
+        build a numpy structured dtype for the fields in a packet definition, except the bit fields,
+        so a batch of packets can be parsed column by column.
+    Inputs:
+        - pkt_def(dict): the packet definition.
+        - itemsize(int): the packet length.
+    Outputs:
+        - dtype(np.dtype): the structured dtype. The strings are raw bytes(void), so no byte is dropped.
+    """
+    names = []
+    formats = []
+    offsets = []
+    for k, v in pkt_def.items():
+        if 'offset' not in v or 'bit' in v:
+            continue
+        flag = DType[v['type']]['flag']
+        names.append(k)
+        offsets.append(v['offset'])
+        formats.append('V%d'%v['length'] if flag == 's' else '<%s'%flag)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+
+_HK_DTYPE = _compile_pkt_dtype(HKPktDef, _HK_STRUCT.size)
+_DAQ_STRUCT, _DAQ_FIELDS, _DAQ_PAYLOAD = _compile_pkt_def(DaqPktDef)
+
+# the acq params command from offset 2: ACQMODE, ACQINT, HOLD1, HOLD2, ADCCLKPH and MONCHAN are little-endian
+# 16-bit words, followed by STIMON, STIM_LEVEL, STIM_RATE, EN_WR_UART, FLASH_RATE, FLASH_LEVEL and FLASH_WIDTH
+# in the even bytes from 14 to 26
+_ACQ_STRUCT = struct.Struct('<6HBxBxBxBxBxBxB')
+# a MAC address in the reply of the packet destination command
+_MAC_STRUCT = struct.Struct('6B')
+# HV_0 to HV_3 are little-endian 16-bit words at offset 2
+_HV_STRUCT = struct.Struct('<HHHH')
+# a little-endian 16-bit word, e.g. the integration time and the focus steps
+_U16_STRUCT = struct.Struct('<H')
+# a little-endian 32-bit word, e.g. the channel masks
+_U32_STRUCT = struct.Struct('<I')
+# the DAQ params command from offset 2: mode, integration time(us - 1), 69(byte 12), STIMON, STIM_LEVEL,
+# STIM_RATE(bytes 14-18), FLASH_RATE, FLASH_LEVEL and FLASH_WIDTH(bytes 22-26)
+_DAQ_CMD_STRUCT = struct.Struct('<BxH6xBxBxBxB3xBxBxB')
+# the focus command from offset 4: steps, shutter byte(byte 6), fan speed(byte 8),
+# endzone, backoff, step_ontime and step_offtime
+_FOCUS_STRUCT = struct.Struct('<HBxBx4H')
+# the shutter byte and the fan speed at bytes 6 and 8 of the shutter/fan commands
+_SHUTTER_FAN_STRUCT = struct.Struct('<BxB')
+# a 64-byte command with all the bytes cleared
+_ZERO_CMD = bytes(64)
+# the 256 PH baselines in the reply of the baseline calibration command
+_BASELINE_STRUCT = struct.Struct('<256H')
+
+def _to_int(v):
+    """
+    Description:
+        convert a config value to int, in case the value is a str(e.g. '0x3e7' or '999').
+    Inputs:
+        - v(int or str): the value.
+    Outputs:
+        - v(int): the value as int.
+    """
+    if isinstance(v, str):
+        return int(v, 0)
+    return int(v)
+
+# recvmmsg(2) and sendmmsg(2) are not exposed by the socket module, so they are called through ctypes on Linux.
+# The structs mirror struct iovec, struct msghdr and struct mmsghdr in <sys/socket.h>.
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+def _load_mmsg(name, argtypes):
+    """
+    Description:
+        get recvmmsg or sendmmsg from libc.
+    Inputs:
+        - name(str): the function name, 'recvmmsg' or 'sendmmsg'.
+        - argtypes(list): the ctypes argument types of the function.
+    Outputs:
+        - f(ctypes function or None): None if the function is not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        f = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+    f.argtypes = argtypes
+    f.restype = ctypes.c_int
+    return f
+
+_recvmmsg = _load_mmsg('recvmmsg', [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p])
+_sendmmsg = _load_mmsg('sendmmsg', [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int])
+# size of struct sockaddr_in
+_SOCKADDR_IN_LEN = 16
+# SO_TIMESTAMP(SCM_TIMESTAMP) on linux, which is not defined in the socket module.
+# The kernel time of each packet comes in a control message, struct cmsghdr followed by struct timeval
+_SO_TIMESTAMP = 29
+_CMSGHDR_STRUCT = struct.Struct('@Nii')
+_TIMEVAL_STRUCT = struct.Struct('@ll')
+# the control messages are aligned to size_t, i.e. CMSG_ALIGN
+_CMSG_ALIGN = struct.calcsize('N')
+_CMSG_DATA_OFFSET = -(-_CMSGHDR_STRUCT.size // _CMSG_ALIGN) * _CMSG_ALIGN
+_CMSG_TIMESTAMP_SPACE = _CMSG_DATA_OFFSET + -(-_TIMEVAL_STRUCT.size // _CMSG_ALIGN) * _CMSG_ALIGN
+
+def _send_msgs(sock, msgs):
+    """
+    Description:
+        send the messages with sendmmsg, so they are sent in one syscall.
+        The messages are sent with sendto one by one, if sendmmsg is not available.
+    Inputs:
+        - sock(socket.socket): the UDP socket.
+        - msgs(list): (data, (ip, port)) pairs.
+    """
+    n = len(msgs)
+    if _sendmmsg is None or n <= 1:
+        for data, addr in msgs:
+            sock.sendto(data, addr)
+        return
+    # struct sockaddr_in: family(host order), port(network order), address, and 8 bytes of zero
+    family = struct.pack('=H', socket.AF_INET)
+    names = {}
+    bufs = []
+    iovs = (_iovec * n)()
+    hdrs = (_mmsghdr * n)()
+    for j, (data, addr) in enumerate(msgs):
+        if addr not in names:
+            names[addr] = ctypes.create_string_buffer(family + struct.pack('>H', addr[1]) + _resolve_ipbytes(addr[0])
+                                                      + bytes(8), _SOCKADDR_IN_LEN)
+        buf = ctypes.create_string_buffer(bytes(data), len(data))
+        bufs.append(buf)
+        iovs[j].iov_base = ctypes.addressof(buf)
+        iovs[j].iov_len = len(data)
+        hdr = hdrs[j].msg_hdr
+        hdr.msg_name = ctypes.addressof(names[addr])
+        hdr.msg_namelen = _SOCKADDR_IN_LEN
+        hdr.msg_iov = ctypes.pointer(iovs[j])
+        hdr.msg_iovlen = 1
+    # sendmmsg may send fewer messages than requested, so send the rest again
+    i = 0
+    while i < n:
+        sent = _sendmmsg(sock.fileno(), ctypes.addressof(hdrs) + i * ctypes.sizeof(_mmsghdr), n - i, 0)
+        if sent < 0:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            raise OSError(e, os.strerror(e))
+        i += sent
+
+def _alloc_mmsg(n, pktlen, ctrllen=0):
+    """
+    Description:
+        allocate the buffers and the mmsghdr array for receiving n packets with recvmmsg.
+    Inputs:
+        - n(int): the number of packets.
+        - pktlen(int): the max length of each packet.
+        - ctrllen(int): the length of the control message buffer of each packet, 0 for no control messages.
+    Outputs:
+        - msgs(ctypes array): the mmsghdr array.
+        - raw(memoryview): the packet buffers, pktlen bytes for each packet.
+        - raw_names(memoryview): the source addresses, a sockaddr_in for each packet.
+        - iovs(ctypes array): the iovec array, which must be kept alive with msgs, because msgs only holds pointers to it.
+        - raw_ctrl(memoryview): the control message buffers, ctrllen bytes for each packet.
+    """
+    bufs = (ctypes.c_char * (n * pktlen))()
+    names = (ctypes.c_char * (n * _SOCKADDR_IN_LEN))()
+    ctrl = (ctypes.c_char * max(n * ctrllen, 1))()
+    iovs = (_iovec * n)()
+    msgs = (_mmsghdr * n)()
+    buf_addr = ctypes.addressof(bufs)
+    name_addr = ctypes.addressof(names)
+    ctrl_addr = ctypes.addressof(ctrl)
+    for j in range(n):
+        iovs[j].iov_base = buf_addr + j * pktlen
+        iovs[j].iov_len = pktlen
+        hdr = msgs[j].msg_hdr
+        hdr.msg_name = name_addr + j * _SOCKADDR_IN_LEN
+        hdr.msg_namelen = _SOCKADDR_IN_LEN
+        hdr.msg_iov = ctypes.pointer(iovs[j])
+        hdr.msg_iovlen = 1
+        if ctrllen:
+            hdr.msg_control = ctrl_addr + j * ctrllen
+            hdr.msg_controllen = ctrllen
+    return msgs, memoryview(bufs).cast('B'), memoryview(names).cast('B'), iovs, memoryview(ctrl).cast('B')
+
+def _parse_pkt(s, fields, pkt, parsed):
+    """
+    Description:
+        parse one packet with a compiled packet definition.
+    Inputs:
+        - s(struct.Struct): the struct returned by _compile_pkt_def.
+        - fields(tuple): the field descriptors returned by _compile_pkt_def.
+        - pkt(bytes): the packet.
+        - parsed(dict): the dict to store the parsed fields.
+    Outputs:
+        - parsed(dict): the parsed fields.
+    """
+    vals = s.unpack_from(pkt)
+    for k, i, lsb, constant, bit, kind in fields:
+        if kind == _PKT_RAW:
+            parsed[k] = vals[i]
+        elif kind == _PKT_SCALED:
+            parsed[k] = vals[i] * lsb + constant
+        elif kind == _PKT_BITS:
+            b = pkt[i]
+            for key, n in bit:
+                parsed[key] = (b >> n) & 0x01
+        elif kind == _PKT_STRING:
+            parsed[k] = vals[i].decode('utf-8')[::-1]
+        else:
+            parsed[k] = _boardloc_str(vals[i])
+    return parsed
+
+def _parse_hk_pkt(pkt, hk_data):
+    """
+    Description:
+        parse one housekeeping packet.
+    Inputs:
+        - pkt(bytes): the housekeeping packet.
+        - hk_data(dict): the dict to store the parsed fields.
+    Outputs:
+        - hk_data(dict): the parsed housekeeping data.
+    """
+    return _parse_pkt(_HK_STRUCT, _HK_FIELDS, pkt, hk_data)
+
+def _parse_hk_pkts(pkts):
+    """
+    Description:
+        parse a batch of housekeeping packets at once.
+        The packets are viewed as a numpy structured array, and each field is scaled/converted for all the packets together.
+    Inputs:
+        - pkts(list): the housekeeping packets, none of them is None.
+    Outputs:
+        - parsed_data(list): a dict of the parsed fields for each packet, the same as _parse_hk_pkt.
+    """
+    size = _HK_STRUCT.size
+    if any(len(pkt) != size for pkt in pkts):
+        return [_parse_hk_pkt(pkt, {}) for pkt in pkts]
+    n = len(pkts)
+    buf = b''.join(pkts)
+    rec = np.frombuffer(buf, dtype=_HK_DTYPE)
+    raw = np.frombuffer(buf, dtype=np.uint8).reshape(n, size)
+    cols = {}
+    for k, i, lsb, constant, bit, kind in _HK_FIELDS:
+        if kind == _PKT_RAW:
+            cols[k] = rec[k].tolist()
+        elif kind == _PKT_SCALED:
+            # keep the same result types as the scalar parser: float if lsb or constant is a float
+            if isinstance(lsb, float) or isinstance(constant, float):
+                col = rec[k].astype(np.float64)
+            else:
+                col = rec[k].astype(np.int64)
+            cols[k] = (col * lsb + constant).tolist()
+        elif kind == _PKT_BITS:
+            b = raw[:, i]
+            for key, nb in bit:
+                cols[key] = ((b >> nb) & 0x01).tolist()
+        elif kind == _PKT_STRING:
+            cols[k] = [x.tobytes().decode('utf-8')[::-1] for x in rec[k]]
+        else:
+            cols[k] = [_boardloc_str(x) for x in rec[k].tolist()]
+    return [{k: c[j] for k, c in cols.items()} for j in range(n)]
+
+@functools.lru_cache(maxsize=None)
+def _sci_parser(mode):
+    """
+    Description:
+        build the parser for the science packets in one mode.
+        The payload descriptor of the mode is bound once, so there is no per-packet mode lookup.
+    Inputs:
+        - mode(str): the mode of the data, 'ph', 'movie-16bit' or 'movie-8bit'.
+    Outputs:
+        - parse(function): parse(pkt, sci_data) parses one packet into sci_data, and returns sci_data.
+                           The data is a read-only numpy view on the packet, so no copy is made.
+    """
+    offset, count, dtype = _DAQ_PAYLOAD[mode]
+    def parse(pkt, sci_data):
+        _parse_pkt(_DAQ_STRUCT, _DAQ_FIELDS, pkt, sci_data)
+        sci_data['data'] = np.frombuffer(pkt, dtype=dtype, count=count, offset=offset)
+        return sci_data
+    return parse
+
+class _TftpStateSentWRQ(tftpy.TftpStates.TftpStateSentWRQ):
+    """
+    Description:
+        The state after a WRQ is sent, which falls back to the default block size(512 bytes)
+        when the server answers with ACK 0 instead of an OACK, i.e. ignores the options(RFC 2347).
+        tftpy only does this for the downloads, so an upload would go on with the larger blocks otherwise.
+    """
+    def handle(self, pkt, raddress, rport):
+        if isinstance(pkt, tftpy.TftpPacketTypes.TftpPacketACK) and pkt.blocknumber == 0 \
+            and self.context.options:
+            log = logging.getLogger('tftpy.TftpStates')
+            log.info('Server ignored options, falling back to defaults')
+            self.context.options = {'blksize': tftpy.TftpShared.DEF_BLKSIZE}
+        return super().handle(pkt, raddress, rport)
+
+class _TftpContextClientUpload(tftpy.TftpContexts.TftpContextClientUpload):
+    """
+    Description:
+        The upload context used by tftpw._upload for the uploads with a block size option,
+        which waits for the reply to the WRQ in _TftpStateSentWRQ. The other tftpy users are not changed.
+    """
+    def cycle(self):
+        # the first state is created in start(), so it is replaced before the first reply is handled
+        if type(self.state) is tftpy.TftpStates.TftpStateSentWRQ:
+            self.state = _TftpStateSentWRQ(self)
+        super().cycle()
+
 class tftpw(object):
     """
     Description:
         The tftpw class is used to reboot quabos, and upload/download golden/silver firmware and wprc filesys.
     """
+    # the block size requested for the downloads(RFC 2348), which keeps a DATA packet in one 1500-byte ethernet frame
+    DOWNLOAD_BLKSIZE = 1468
+    # the flash UIDs read in this process, {(ip, port): uid}, which are reused by get_flashuid(cached=True)
+    _flashuids = {}
+    # the log handlers are set up once in a process, see _setup_logging
+    _log_ready = False
     def __init__(self,ip,port=69):
+        self.addr = (ip, port)
         self.client = tftpy.TftpClient(ip,port)
-        self.logger = Util.create_logger('logs/firmware.log', mode='a', tag='Firmware')
+        # the downloads ask for a larger block size, so there are fewer round trips for each chunk.
+        # A server ignoring the option falls back to 512 bytes(in tftpy for the downloads, and in
+        # _TftpStateSentWRQ for the uploads), and a server rejecting it is handled in _download/_upload.
+        # The uploads keep the default block size, because they are written to the flash,
+        # unless the caller of the put_* methods asks for a larger one.
+        self.download_client = tftpy.TftpClient(ip, port, options={'blksize': tftpw.DOWNLOAD_BLKSIZE})
+        self._blksize_ok = True
+        # the uploads only ask for a larger block size when the caller passes one, and fall back in _upload
+        self._upload_blksize_ok = True
+        tftpw._setup_logging()
+        self.logger = logging.getLogger('Firmware')
         self.logger.info('TFTP client created for %s'%ip)
+
+    @staticmethod
+    def _setup_logging():
+        """
+        Description:
+            set up the firmware log and the log in tftpy.
+            It is done once, so creating several clients, e.g. for several quabos,
+            doesn't truncate tftpy.log again or replace the handlers used by the other clients.
+        """
+        if tftpw._log_ready:
+            return
+        Util.create_logger('logs/firmware.log', mode='a', tag='Firmware')
         # deal with log in tftpy
         log_tags = ["tftpy.TftpStates", "tftpy.TftpContext"]
         for tag in log_tags:
@@ -594,6 +1135,61 @@ class tftpw(object):
             if logger.handlers:
                 logger.handlers.clear()
             logger.addHandler(handler)
+        tftpw._log_ready = True
+
+    def _download(self, remote_filename, output):
+        """
+        Description:
+            download a file with the larger block size, and retry with the default block size
+            if the server rejects the option.
+        Inputs:
+            - remote_filename(str): the remote file name.
+            - output(str or file object): the local file name, or the file object the data is appended to.
+        """
+        if self._blksize_ok:
+            pos = output.tell() if hasattr(output, 'write') else None
+            try:
+                self.download_client.download(remote_filename, output)
+                return
+            except tftpy.TftpTimeout:
+                # a slow or unreachable quabo says nothing about the block size, so it is not retried
+                raise
+            except tftpy.TftpException as e:
+                self.logger.warning('blksize %d is not supported(%s), use the default block size'%(tftpw.DOWNLOAD_BLKSIZE, e))
+                self._blksize_ok = False
+                # drop the partial data written by the failed download
+                if pos is not None:
+                    output.seek(pos)
+                    output.truncate()
+        self.client.download(remote_filename, output)
+
+    def _upload(self, remote_filename, filename, blksize=None):
+        """
+        Description:
+            upload a file with the given block size(RFC 2348), and retry with the default block size
+            if the server rejects the option.
+        Inputs:
+            - remote_filename(str): the remote file name.
+            - filename(str): the local file name. tftpy closes the file after each attempt,
+                             so the file is opened again by the retry.
+            - blksize(int): the block size, None to use the default block size(512 bytes).
+        """
+        if blksize and self._upload_blksize_ok:
+            try:
+                # an invalid block size is rejected by tftpy when the client is created
+                client = tftpy.TftpClient(self.addr[0], self.addr[1], options={'blksize': blksize})
+                # the same as client.upload, but with the fallback to 512 bytes if the server ignores the option
+                with _TftpContextClientUpload(client.host, client.iport, remote_filename, filename,
+                                              client.options, None, tftpy.SOCK_TIMEOUT) as c:
+                    c.start()
+                return
+            except tftpy.TftpTimeout:
+                # a timeout in the middle of the flash write is reported, instead of writing it again
+                raise
+            except tftpy.TftpException as e:
+                self.logger.warning('blksize %d is not supported(%s), use the default block size'%(blksize, e))
+                self._upload_blksize_ok = False
+        self.client.upload(remote_filename, filename)
 
     def help(self):
         """
@@ -609,19 +1205,27 @@ class tftpw(object):
         print('  put_bin_file(file)      : put fpga bin file to flash chip. [default from 0x01010000]')
         print('  reboot()                : reboot fpga. [default from 0x01010000]')
     
-    def get_flashuid(self,filename='flashuid'):
+    def get_flashuid(self,filename='flashuid',cached=False):
         """
         Description:
             get flash device ID from flash chip.
         Inputs:
             - filename(str): the file name to save flash device ID.
-        """
+            - cached(bool): reuse the flash device ID read from the same quabo in this process, 
+                            instead of downloading it again.
+        """
+        if cached:
+            flashuid = tftpw._flashuids.get(self.addr)
+            if flashuid is not None:
+                self.logger.debug('Flash Device ID(cached): %s', flashuid)
+                return flashuid
         self.logger.info('Download flash Device ID from panoseti flash chip...')
-        self.client.download('/flashuid',filename)
+        self._download('/flashuid',filename)
         with open(filename,'rb') as fp:
             flashuid = fp.read()
         self.logger.info('Get flash Device ID successfully!')
-        self.logger.debug('Flash Device ID: %s'%flashuid.hex())
+        self.logger.debug('Flash Device ID: %s', flashuid.hex())
+        tftpw._flashuids[self.addr] = flashuid.hex()
         return flashuid.hex()
         
     def get_wrpc_filesys(self, filename='wrpc_filesys',addr=0x00e00000):
@@ -635,27 +1239,16 @@ class tftpw(object):
             - addr(int): the start address to read wrpc file system from flash chip.
         """
         self.logger.info('Download wrpc file system from panoseti flash chip...')
-        fp_w = open(filename,'wb')
         # we can get 65535 bytes each time, so we need to repeat the download operation for 16 times
         # for convenience, we read 32768 bytes each time
-        for i in range(0,34):
-            addr_tmp = addr + i*0x8000 
-            offset = str(hex(addr_tmp))
-            remote_filename = '/flash.' + offset[2:] + '.8000'
-            # print('remote_filename :',remote_filename)
-            # download the file to 'tmp'
-            self.client.download(remote_filename,'tmp')
-            # open 'tmp'
-            fp_r = open('tmp','rb')
-            # read data out
-            data = fp_r.read()
-            # write the data to the final file
-            fp_w.write(data)
-            # close 'tmp'
-            fp_r.close()
-        fp_r.close()
-        fp_w.close()
-        os.remove('tmp')
+        # the chunks are written to the final file directly
+        with open(filename,'wb') as fp_w:
+            for i in range(0,34):
+                addr_tmp = addr + i*0x8000 
+                offset = str(hex(addr_tmp))
+                remote_filename = '/flash.' + offset[2:] + '.8000'
+                # print('remote_filename :',remote_filename)
+                self._download(remote_filename,fp_w)
         self.logger.info('Download wrpc file system successfully!')
         
     def get_mb_file(self, filename='mb_file',addr=0x00F10000):
@@ -669,29 +1262,19 @@ class tftpw(object):
             - addr(int): the start address to read mb file from flash chip.
         """
         self.logger.info('Download mb file from panoseti mb_file space...')
-        fp_w = open(filename,'wb')
         # we can get 65535 bytes each time, so we need to repeat the download operation for 16 times
         # for convenience, we read 32768 bytes each time
-        for i in range(0,32):
-            addr_tmp = addr + i*0x8000 
-            offset = str(hex(addr_tmp))
-            remote_filename = '/flash.' + offset[2:] + '.8000'
-            # print('remote_filename :',remote_filename)
-            # download the file to 'tmp'
-            self.client.download(remote_filename,'tmp')
-            # open 'tmp'
-            fp_r = open('tmp','rb')
-            # read data out
-            data = fp_r.read()
-            # write the data to the final file
-            fp_w.write(data)
-            # close 'tmp'
-            fp_r.close()
-        fp_w.close()
-        os.remove('tmp')
+        # the chunks are written to the final file directly
+        with open(filename,'wb') as fp_w:
+            for i in range(0,32):
+                addr_tmp = addr + i*0x8000 
+                offset = str(hex(addr_tmp))
+                remote_filename = '/flash.' + offset[2:] + '.8000'
+                # print('remote_filename :',remote_filename)
+                self._download(remote_filename,fp_w)
         self.logger.info('Download mb file successfully!')
         
-    def put_wrpc_filesys(self,filename='wrpc_filesys', addr=0x00E00000):
+    def put_wrpc_filesys(self,filename='wrpc_filesys', addr=0x00E00000, blksize=None):
         """
         Description:
             put wrpc file system to flash chip.
@@ -699,20 +1282,21 @@ class tftpw(object):
         Inputs:
             - filename(str): the file name to upload to flash chip.
             - addr(int): the start address to write wrpc file system to flash chip.
+            - blksize(int): the TFTP block size, None to use the default block size.
         """
         self.logger.info('Upload %s to panoseti wrpc_filesys space...'%filename)
         offset = str(hex(addr))
         remote_filename = '/flash.' + offset[2:]
         # print('remote_filename  ',remote_filename)
-        size = os.path.getsize(filename)
+        size = os.stat(filename).st_size
         # check the size of wrpc_filesys
         if size != 0x110000 :
             print('The size of wrpc_filesys is incorrect, please check it!')
             return
-        self.client.upload(remote_filename,filename)    
+        self._upload(remote_filename, filename, blksize)
         self.logger.info('Upload %s to panoseti wrpc_filesys space successfully!' %filename)
         
-    def put_mb_file(self,filename='mb_file', addr=0x00F10000):
+    def put_mb_file(self,filename='mb_file', addr=0x00F10000, blksize=None):
         """
         Description:
             put mb file to flash chip.
@@ -720,20 +1304,21 @@ class tftpw(object):
         Inputs:
             - filename(str): the file name to upload to flash chip.
             - addr(int): the start address to write mb file to flash chip.
+            - blksize(int): the TFTP block size, None to use the default block size.
         """
         self.logger.info('Upload %s to panoseti mb_file space...'%filename)
         offset = str(hex(addr))
         remote_filename = '/flash.' + offset[2:]
         # print('remote_filename  ',remote_filename)
-        size = os.path.getsize(filename)
+        size = os.stat(filename).st_size
         # check the size of mb_file
         if size > 0x100000 :
             self.logger.error('The size of mb file is too large, and it will mess up other parts on the flash chip!')
             return
-        self.client.upload(remote_filename,filename)
+        self._upload(remote_filename, filename, blksize)
         self.logger.info('Upload %s to panoseti mb_file space successfully!' %filename)
         
-    def put_bin_file(self,filename,addr=0x01010000):
+    def put_bin_file(self,filename,addr=0x01010000, blksize=None):
         """
         Description:
             put fpga bin file to flash chip.
@@ -741,12 +1326,13 @@ class tftpw(object):
         Inputs:
             - filename(str): the file name to upload to flash chip.
             - addr(int): the start address to write bin file to flash chip.
+            - blksize(int): the TFTP block size, None to use the default block size.
         """
         self.logger.info('Upload %s to panoseti bin file space...'%filename)
         offset = str(hex(addr))
         remote_filename = '/flash.' + offset[2:]
         # print('remote_filename :',remote_filename)
-        self.client.upload(remote_filename,filename)
+        self._upload(remote_filename, filename, blksize)
         self.logger.info('Upload %s to panoseti bin file space successfully!' %filename)
         
     def reboot(self,addr=0x00010100):
@@ -758,12 +1344,8 @@ class tftpw(object):
                          For the PANOSETI project, it's hard coded to 0x00010100 in the firmware. 
         """
         remote_filename = '/progdev'
-        filename = 'tmp.prog'
-        fp = open(filename,'wb')
-        for i in range(1,5):
-            s = struct.pack('B', addr>>(8*(4-i))&0xFF)
-            fp.write(s)
-        fp.close()
+        # the address is sent as 4 bytes, MSB first, straight from memory
+        prog = io.BytesIO(struct.pack('>I', addr & 0xFFFFFFFF))
         """
         print('*******************************************************')
         print('FPGA is rebooting, just ignore the timeout information')
@@ -772,10 +1354,9 @@ class tftpw(object):
         """
         self.logger.info('Rebooting FPGA...')
         try:
-            self.client.upload(remote_filename,filename)
+            self.client.upload(remote_filename,prog)
         except:
             pass
-        os.remove(filename)
         
 class QuaboSock(object):
     """
@@ -792,6 +1373,8 @@ class QuaboSock(object):
         """
         self.ip_addr = ip_addr
         self.port = port
+        # the buffer used by recv_np, which is allocated on the first call
+        self._recv_np_buf = None
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(timeout)
         self.sock.bind(("", self.port))
@@ -809,7 +1392,30 @@ class QuaboSock(object):
             return data
         except:
             return None
-        
+
+    def recv_np(self, len, dtype=np.uint16):
+        """
+        Description:
+            receive a packet from the quabo into a reused buffer, and return it as a numpy array.
+            The array is a view on the buffer, so it is overwritten by the next call;
+            copy it if it needs to be kept.
+        Inputs:
+            - len(int): the max length of the packet.
+            - dtype(np.dtype): the data type of the array.
+        Outputs:
+            - data(np.ndarray): the received data, or None if nothing is received.
+        """
+        buf = self._recv_np_buf
+        if buf is None or buf.nbytes < len:
+            buf = memoryview(bytearray(max(len, 8192)))
+            self._recv_np_buf = buf
+        try:
+            nbytes, addr = self.sock.recvfrom_into(buf, len)
+        except:
+            return None
+        itemsize = np.dtype(dtype).itemsize
+        return np.frombuffer(buf.obj, dtype=dtype, count=nbytes//itemsize)
+
     def send(self, data):
         """
         Description:
@@ -817,18 +1423,37 @@ class QuaboSock(object):
         Inputs:
             - data(bytearray): the data to be sent.
         """
-        self.sock.sendto(bytes(data), (self.ip_addr, self.port))
+        self.sock.sendto(data, (self.ip_addr, self.port))
+
+    def _set_recv_buff(self, size):
+        """
+        Description:
+            set the receive buffer size of the socket, so that the packets are not dropped during a burst.
+            SO_RCVBUFFORCE needs CAP_NET_ADMIN, otherwise SO_RCVBUF is used, which is capped by net.core.rmem_max.
+        Inputs:
+            - size(int): the receive buffer size in bytes.
+        Outputs:
+            - size(int): the receive buffer size reported by the kernel.
+        """
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_RCVBUFFORCE', socket.SO_RCVBUF), size)
+        except OSError:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
 
     def flush_rx_buf(self):
         """
         Description:
             flush the rx buffer.
         """
-        # read until the buffer is empty
+        # read until the buffer is empty, without waiting for the socket timeout when there is nothing queued
         while True:
+            ready, _, _ = select.select([self.sock], [], [], 0)
+            if not ready:
+                break
             try:
-                x = self.sock.recvfrom(2048)
-            except:
+                self.sock.recvfrom(2048)
+            except OSError:
                 break
 
     def close(self):
@@ -907,6 +1532,10 @@ class QuaboConfig(QuaboSock):
         'IMAGE_8BIT'            : 0x4,
         'NO_BASELINE_SUBTRACT'  : 0x10
     }
+    # the max number of packets dropped by flush_rx_buf
+    FLUSH_PKTS = 32
+    # endzone(300), backoff(200), step_ontime(10000) and step_offtime(10000) used by SetFocus
+    FOCUS_PARAMS = (300, 200, 10000, 10000)
     
     def __init__(self, ip_addr, quabo_config_file = 'configs/quabo_config.json', logger='Quabo'):
         """
@@ -919,7 +1548,7 @@ class QuaboConfig(QuaboSock):
         """
         # create logger
         self.logger = logging.getLogger('%s.QuaboConfig'%logger)
-        self.logger.debug('Quabo IP - %s'%ip_addr)
+        self.logger.debug('Quabo IP - %s', ip_addr)
         # call the parent constructor
         try:
             super().__init__(ip_addr, QuaboConfig.PORTS['CMD'])
@@ -928,16 +1557,52 @@ class QuaboConfig(QuaboSock):
             print(e)
         # get quabo config
         self.quabo_config_file = quabo_config_file
-        with open(self.quabo_config_file) as f:
-            self.quabo_config = json.load(f)
+        self.quabo_config = _load_quabo_config(self.quabo_config_file)
+        # convert the acq values to int once, so they are not parsed again for each command
+        acq = self.quabo_config['acq']
+        for k, v in acq.items():
+            acq[k] = _to_int(v)
 
         # global parameters for the class, which are not exposed to users.
-        self._shutter_open = 0
-        self._shutter_power = 0
+        # bit 0 is shutter open, bit 1 is shutter power
+        self._shutter_byte = 0
         self._fanspeed = 0
-        self._MAROC_regs = []
-        for i in range (4):
-            self._MAROC_regs.append([0 for x in range(104)])
+        self._MAROC_regs = np.zeros((4, 104), dtype=np.uint8)
+        # bit fields of the maroc tags, which are resolved once when the tags are configured
+        self._maroc_fields = {}
+        # the parsed values of the maroc tags, {tag: (config string, values)}
+        self._maroc_vals = {}
+        # the packed maroc registers, (tags and values, registers of the 4 chips)
+        self._maroc_cache = None
+        # the config files written by _update_config, {path: ((mtime, size), config)}
+        self._config_files = {}
+        # the HV values of the 4 channels, which are kept in sync with quabo_config by HvConfig
+        hv = self.quabo_config['hv']
+        self._hv = [_to_int(hv.get('HV_%d'%i, 0)) for i in range(4)]
+        # the buffer used by _reset_cmd, which is shared by the 64-byte commands
+        self._cmd_buf = bytearray(64)
+        # the buffer of the 492-byte MAROC command used by SetMarocParams
+        self._maroc_buf = bytearray(492)
+        # (channel, tag) of the CHANMASK tags, which are parsed once here
+        self._set_chanmask_index(sorted((int(tag.split('_')[1]), tag)
+                                        for tag in self.quabo_config['chanmask'] if tag.startswith('CHANMASK')))
+        for tag in self.quabo_config['maroc']:
+            self._update_maroc_field(tag)
+        # the commands queued by batched(), None if the commands are sent right away
+        self._pending = None
+        # the recvmmsg buffers used by flush_rx_buf, which are allocated on the first flush
+        self._flush_bufs = None
+
+    def _update_maroc_field(self, tag):
+        """
+        Description:
+            resolve and cache the bit field of a MAROC tag.
+        Inputs:
+            - tag(str): the tag.
+        """
+        field = self._maroc_field(tag)
+        if field is not None:
+            self._maroc_fields[tag] = field
 
     def send(self, cmd):
         """
@@ -946,7 +1611,108 @@ class QuaboConfig(QuaboSock):
         Inputs(bytearray):
             - cmd: the command to be sent.
         """
-        self.sock.sendto(bytes(cmd), (self.ip_addr, QuaboConfig.PORTS['CMD']))
+        if self._pending is not None:
+            # copy the queued command, because the caller may reuse cmd for the next command
+            self._pending.append(bytes(cmd))
+            return
+        # sendto takes the bytearray directly, so there is no need to copy it to bytes
+        self.sock.sendto(cmd, (self.ip_addr, QuaboConfig.PORTS['CMD']))
+
+    def recv(self, len):
+        """
+        Description:
+            receive the reply from the quabo.
+            The queued commands are sent first, because the reply may depend on them.
+        Outputs:
+            - data(bytearray): the received data.
+        """
+        self._send_pending()
+        return super().recv(len)
+
+    @contextlib.contextmanager
+    def batched(self):
+        """
+        Description:
+            queue the commands sent in the with block, and send them with one sendmmsg call at the end,
+            e.g. with qc.batched(): qc.SetHv('off'); qc.DaqParamsConfig(params)
+            The queued commands are also sent before receiving a reply.
+        """
+        if self._pending is not None:
+            # nested, the outer block sends the commands
+            yield self
+            return
+        self._pending = []
+        try:
+            yield self
+        finally:
+            self._send_pending()
+            self._pending = None
+
+    def _send_pending(self):
+        """
+        Description:
+            send the queued commands, with sendmmsg if it is available.
+        """
+        if not self._pending:
+            return
+        cmds, self._pending[:] = list(self._pending), []
+        addr = (self.ip_addr, QuaboConfig.PORTS['CMD'])
+        _send_msgs(self.sock, [(cmd, addr) for cmd in cmds])
+
+    @staticmethod
+    def SendBatch(cmds):
+        """
+        Description:
+            send the commands to several quabos with one sendmmsg call,
+            e.g. QuaboConfig.SendBatch([(qc0, cmd0), (qc1, cmd1)]).
+            Every message carries its own address, so all of them are sent through the socket of the first
+            QuaboConfig, which is bound to the CMD port like the others.
+        Inputs:
+            - cmds(list): (QuaboConfig, cmd) pairs. The commands are sent in order.
+        """
+        if not cmds:
+            return
+        msgs = []
+        for qc, cmd in cmds:
+            # send the commands queued by batched() first, so the order is kept
+            qc._send_pending()
+            msgs.append((bytes(cmd), (qc.ip_addr, QuaboConfig.PORTS['CMD'])))
+        _send_msgs(cmds[0][0].sock, msgs)
+
+    def ApplyConfig(self, echo = 1):
+        """
+        Description:
+            send the quabo config to the quabo: the HK packet destination, the acquisition parameters,
+            the trigger mask, the GOE mask and the MAROC parameters.
+            The commands without a reply are sent with one sendmmsg call, and then the MAROC parameters
+            are sent on their own, because they wait for the reply.
+            The HV is not changed, which is still turned on/off by SetHv.
+        Inputs:
+            - echo(int): the echo enable for the MAROC parameters.
+        Outputs:
+            - True if the MAROC reply is correct, otherwise False.
+        """
+        self.logger.debug('apply quabo config')
+        with self.batched():
+            self.SetHkPacketDest()
+            self.SetAcqParams()
+            self.SetTriggerMask()
+            self.SetGoeMask()
+        return self.SetMarocParams(echo=echo)
+
+    def _reset_cmd(self, cmd):
+        """
+        Description:
+            make a command in the command buffer of the class, so no new buffer is allocated for each command.
+            The command is only valid until the next command is made, and the batched commands are copied
+            when they are queued.
+        Inputs:
+            - cmd(byte): the command to be made.
+        """
+        x = self._cmd_buf
+        x[:] = _ZERO_CMD
+        x[0] = cmd
+        return x
 
     def make_cmd(self, cmd):
         """
@@ -955,9 +1721,8 @@ class QuaboConfig(QuaboSock):
         Inputs:
             - cmd(byte): the command to be made.
         """
+        # bytearray is already zero-filled
         x = bytearray(64)
-        for i in range(64):
-            x[i] = 0
         x[0] = cmd
         return x
 
@@ -966,16 +1731,24 @@ class QuaboConfig(QuaboSock):
         Description:
             flush the rx buffer.
         """
-        count = 0
-        nbytes = 0
-        while (count<32):
-            try:
-                x = self.sock.recvfrom(2048)
-                # returns (data, ip_addr)
-                nbytes += len(x[0])
-                count += 1
-            except:
-                break
+        # only the packets already queued are flushed, so an empty buffer doesn't wait for the socket timeout
+        if _recvmmsg is not None:
+            if self._flush_bufs is None:
+                self._flush_bufs = _alloc_mmsg(QuaboConfig.FLUSH_PKTS, 2048)
+            # drain up to FLUSH_PKTS packets in one syscall
+            _recvmmsg(self.sock.fileno(), ctypes.addressof(self._flush_bufs[0]), QuaboConfig.FLUSH_PKTS, socket.MSG_DONTWAIT, None)
+            return
+        # the socket module waits for the timeout even with MSG_DONTWAIT, so switch to non-blocking for the flush
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            for count in range(QuaboConfig.FLUSH_PKTS):
+                try:
+                    self.sock.recv(2048)
+                except OSError:
+                    break
+        finally:
+            self.sock.settimeout(timeout)
 
     def close(self):
         """
@@ -992,7 +1765,7 @@ class QuaboConfig(QuaboSock):
             - params(DAQ_PARAMS): the daq parameters.
         """
         self.logger.debug('configure DAQ parameters')
-        cmd = self.make_cmd(0x03)
+        cmd = self._reset_cmd(0x03)
         mode = 0
         if params.do_image:
             mode |= QuaboConfig.ACQ_MODE['IMAGE_16BIT']
@@ -1006,39 +1779,35 @@ class QuaboConfig(QuaboSock):
         if not params.bl_subtract:
             mode |= QuaboConfig.ACQ_MODE['NO_BASELINE_SUBTRACT']
             self.logger.debug('no baseline subtract')
-        self.logger.debug('mode: %02x'%mode)
-        cmd[2] = mode
+        self.logger.debug('mode: %02x', mode)
         params.image_us = params.image_us - 1
-        cmd[4] = params.image_us % 256
-        cmd[5] = params.image_us // 256
-        self.logger.debug('Integration time is %d us'% params.image_us)
-        cmd[12] = 69
+        self.logger.debug('Integration time is %d us', params.image_us)
         # if flash led is enable
+        flash = (0, 0, 0)
         if params.do_flash:
             self.logger.debug('Flash LED is on')
-            cmd[22] = params.flash_rate
-            self.logger.debug('Flash rate is %d (%d Hz)'%(params.flash_rate, \
-                                                          LSBParams['flash']['rate'][params.flash_rate]))
-            cmd[24] = params.flash_level
-            self.logger.debug('Flash level is %d (%d v)'%(params.flash_level, \
-                                                          params.flash_level * LSBParams['flash']['level']))
-            cmd[26] = params.flash_width
-            self.logger.debug('Flah widht is %d (%d ns)'%(params.flash_width,\
-                                                          params.flash_width * LSBParams['flash']['width']))
+            flash = (params.flash_rate, params.flash_level, params.flash_width)
+            self.logger.debug('Flash rate is %d (%d Hz)', params.flash_rate,
+                              LSBParams['flash']['rate'][params.flash_rate])
+            self.logger.debug('Flash level is %d (%d v)', params.flash_level,
+                              params.flash_level * LSBParams['flash']['level'])
+            self.logger.debug('Flah widht is %d (%d ns)', params.flash_width,
+                              params.flash_width * LSBParams['flash']['width'])
         else:
             self.logger.debug('Flash LED is off')
         # if stim is enabled
+        stim = (0, 0, 0)
         if params.do_stim:
-            cmd[14] = 1
+            stim = (1, params.stim_level, params.stim_rate)
             self.logger.debug('STIM is on')
-            cmd[16] = params.stim_level
             # TODO: add debug info for STIM
-            self.logger.debug('STIM level is %d'%params.stim_level)
-            cmd[18] = params.stim_rate
-            self.logger.debug('STIM rate is %d (%.2f Hz)'%(params.stim_rate,
-                                                           LSBParams['stim'][params.stim_rate]))
+            self.logger.debug('STIM level is %d', params.stim_level)
+            self.logger.debug('STIM rate is %d (%.2f Hz)', params.stim_rate,
+                              LSBParams['stim']['rate'][params.stim_rate])
         else:
             self.logger.debug('STIM is off')
+        # the whole command after the opcode is packed in one call
+        _DAQ_CMD_STRUCT.pack_into(cmd, 2, mode, params.image_us, 69, *stim, *flash)
         self.send(cmd)
 
     def PhPktDestConfig(self, dest_str):
@@ -1048,7 +1817,7 @@ class QuaboConfig(QuaboSock):
         Inputs:
             - dest_str(str): the dest ip address or hostname for PH packets.
         """
-        self.logger.debug('configure PH packets destination IP: %s'%dest_str)
+        self.logger.debug('configure PH packets destination IP: %s', dest_str)
         self.quabo_config['dest_ips']['PH'] = dest_str
     
     def moviePktDestConfig(self, dest_str):
@@ -1058,7 +1827,7 @@ class QuaboConfig(QuaboSock):
         Inputs:
             - dest_str(str): the dest ip address or hostname for movie packets.
         """
-        self.logger.debug('configure movie packets destination IP: %s'%dest_str)
+        self.logger.debug('configure movie packets destination IP: %s', dest_str)
         self.quabo_config['dest_ips']['movie'] = dest_str
 
     def SetDataPktDest(self):
@@ -1071,14 +1840,12 @@ class QuaboConfig(QuaboSock):
         ips = self.quabo_config['dest_ips']
         ph_ip = ips['PH']
         movie_ip = ips['MOVIE']
-        self.logger.debug('set PH packets destination IPs: %s'%ph_ip)
-        self.logger.debug('set MOVIE packets destination IPs: %s'%movie_ip)
+        self.logger.debug('set PH packets destination IPs: %s', ph_ip)
+        self.logger.debug('set MOVIE packets destination IPs: %s', movie_ip)
         # get the IP address from hostname
-        ph_ip_addr_str = socket.gethostbyname(ph_ip)
-        ph_ip_addr_bytes = Util.ip_addr_str_to_bytes(ph_ip_addr_str)
-        movie_ip_addr_str = socket.gethostbyname(movie_ip)
-        movie_ip_addr_bytes = Util.ip_addr_str_to_bytes(movie_ip_addr_str)
-        cmd = self.make_cmd(0x0a)
+        ph_ip_addr_bytes = _resolve_ipbytes(ph_ip)
+        movie_ip_addr_bytes = _resolve_ipbytes(movie_ip)
+        cmd = self._reset_cmd(0x0a)
         for i in range(4):
             cmd[i+1] = ph_ip_addr_bytes[i]
             cmd[i+5] = movie_ip_addr_bytes[i]
@@ -1094,14 +1861,12 @@ class QuaboConfig(QuaboSock):
             return None
         else:
             mac_addr = {}
-            mac_addr['PH'] = struct.unpack('6B',reply[0:6])
-            mac_bytes = reply[0:6]
-            mac_ph = ':'.join(['%02x'%x for x in mac_bytes])
-            self.logger.debug('PH packets destination MAC: %s'%mac_ph)
-            mac_addr['MOVIE'] = struct.unpack('6B',reply[6:12])
-            mac_bytes = reply[6:12]
-            mac_movie = ':'.join(['%02x'%x for x in mac_bytes])
-            self.logger.debug('MOVIE packets destination MAC: %s'%mac_movie)
+            mac_addr['PH'] = _MAC_STRUCT.unpack_from(reply, 0)
+            mac_ph = reply[0:6].hex(':')
+            self.logger.debug('PH packets destination MAC: %s', mac_ph)
+            mac_addr['MOVIE'] = _MAC_STRUCT.unpack_from(reply, 6)
+            mac_movie = reply[6:12].hex(':')
+            self.logger.debug('MOVIE packets destination MAC: %s', mac_movie)
             return mac_addr
 
     def HkPacketDestConfig(self, dest_str):
@@ -1111,7 +1876,7 @@ class QuaboConfig(QuaboSock):
         Inputs:
             - dest_str(str): the dest ip address or hostname for HK packets.
         """
-        self.logger.debug('configure HK packets destination IP: %s'%dest_str)
+        self.logger.debug('configure HK packets destination IP: %s', dest_str)
         self.quabo_config['dest_ips']['HK'] = dest_str   
 
     def SetHkPacketDest(self):
@@ -1121,63 +1886,69 @@ class QuaboConfig(QuaboSock):
         """
         # get the IP address from hostname
         dest_str = self.quabo_config['dest_ips']['HK']
-        ip_addr_str = socket.gethostbyname(dest_str)
-        self.logger.debug('set HK packets destination IP: %s'%ip_addr_str)
-        ip_addr_bytes = Util.ip_addr_str_to_bytes(ip_addr_str)
-        cmd = self.make_cmd(0x0b)
+        self.logger.debug('set HK packets destination IP: %s', dest_str)
+        ip_addr_bytes = _resolve_ipbytes(dest_str)
+        cmd = self._reset_cmd(0x0b)
         for i in range(4):
             cmd[i+1] = ip_addr_bytes[i]
         self.send(cmd)
 
-    def _set_bits(self, chip, lsb_pos, field_width, value):
+    def _maroc_field(self, tag):
         """
         Description:
-            Set bits in MAROC_regs[chip] according to the input values.
-            Maximum value for field_width is 16 (a value can only span three bytes).
+            look up the bit field of a MAROC tag.
         Inputs:
-            - chip(int): the chip number.
-            - lsb_pos(int): the lsb position.
-            - field_width(int): the field width.
-            - value(int): the value.
-        """
-        if (field_width >16): return
-        if ((field_width + lsb_pos) > QuaboConfig.SERIAL_COMMAND_LENGTH): return
-        shift = (lsb_pos % 8)
-        byte_pos = int((lsb_pos+7-shift)/8)
-        mask=0
-        for ii in range(0, field_width):
-            mask = mask << 1
-            mask = (mask | 0x1)
-        mask = mask << shift
-
-        self._MAROC_regs[chip][byte_pos] = self._MAROC_regs[chip][byte_pos] & ((~mask) & 0xff)
-        self._MAROC_regs[chip][byte_pos] = self._MAROC_regs[chip][byte_pos] | ((value << shift) & 0xff)
-        #if field spans a byte boundary
-        if ((shift + field_width) > 8):
-            self._MAROC_regs[chip][byte_pos + 1] = self._MAROC_regs[chip][byte_pos + 1] & ((~(mask>>8)) & 0xff)
-            self._MAROC_regs[chip][byte_pos + 1] = self._MAROC_regs[chip][byte_pos + 1] | (((value >> (8-shift))) & 0xff)
-        if ((shift + field_width) > 16):
-            self._MAROC_regs[chip][byte_pos + 2] = self._MAROC_regs[chip][byte_pos + 2] & ((~(mask>>16)) & 0xff)
-            self._MAROC_regs[chip][byte_pos + 2] = self._MAROC_regs[chip][byte_pos + 2] | (((value >> (16-shift))) & 0xff)
+            - tag(str): the tag.
+        Outputs:
+            - field(tuple): (lsb, width, reverse) of the bit field, or None if the tag is unknown.
+        """
+        v = MarocRegDef.get(tag) or MarocChanRegDef.get(tag)
+        if v is not None:
+            lsb, width, reverse = v['lsb'], v['width'], v['reverse']
+        # the other spellings of the channel number(e.g. 'GAIN07') are parsed below
+        # MASKOR1, MASKOR2 and CTEST: chan is in range 0-63, with a quad of values, one for each chip
+        elif tag.startswith('MASKOR1'):
+            lsb, width, reverse = 154 - 2*int(tag.split('_')[1]), 1, 0
+        elif tag.startswith('MASKOR2'):
+            lsb, width, reverse = 153 - 2*int(tag.split('_')[1]), 1, 0
+        elif tag.startswith('CTEST'):
+            lsb, width, reverse = 828 - int(tag.split('_')[1]), 1, 0
+        # GAIN: chan is in range 0-63, and the bits need to be reversed
+        elif tag.startswith('GAIN'):
+            lsb, width, reverse = 757 - 9*int(tag.split('N')[1]), 8, 8
+        else:
+            return None
+        # a field can span three bytes at most, and it can't be out of the serial command
+        if width > 16 or lsb < 0 or lsb + width > QuaboConfig.SERIAL_COMMAND_LENGTH:
+            return None
+        return (lsb, width, reverse)
 
-    def _set_bits_4(self, tag, vals, lsb_pos, field_width):
+    def _maroc_tag_vals(self, tag, v, reverse):
         """
         Description:
-            take a 4-element list and call set_bits for each MAROC.
+            parse the 4 values(one for each chip) of a MAROC tag, and reverse the bits if needed.
+            The result is cached with the config string, so a tag is only parsed again when its value changes.
         Inputs:
             - tag(str): the tag.
-            - vals(list): the values.
-            - lsb_pos(int): the lsb position.
-            - field_width(int): the field
-        """
-        #vals = instring.split(",")
-        if (len(vals) != 4):
+            - v(str): the values in the quabo config, e.g. '0x1,0x1,0x1,0x1'.
+            - reverse(int): the width of the bits to reverse, 0 if the bits are not reversed.
+        Outputs:
+            - vals(np.ndarray): the 4 values.
+        """
+        cached = self._maroc_vals.get(tag)
+        if cached is not None and cached[0] == v:
+            return cached[1]
+        # Make a list of the should-be 4 ascii values
+        pieces = v.split(',')
+        if (len(pieces) != 4):
             raise Exception("need 4 elements for " + tag +"\n")
-        self._set_bits(0, lsb_pos, field_width, vals[0])
-        self._set_bits(1, lsb_pos, field_width, vals[1])
-        self._set_bits(2, lsb_pos, field_width, vals[2])
-        self._set_bits(3, lsb_pos, field_width, vals[3])
-    
+        vals = np.array([int(x, 0) for x in pieces], dtype=np.uint16)
+        # reverse the bits for DAC1, DAC2 and GAIN
+        if reverse:
+            vals = _MAROC_REV[reverse][vals & ((1 << reverse) - 1)]
+        self._maroc_vals[tag] = (v, vals)
+        return vals
+
     def _make_maroc_cmd(self, cmd, echo = 0):
         """
         Description:
@@ -1191,234 +1962,42 @@ class QuaboConfig(QuaboSock):
         else:
             cmd[0] = 0x01
         maroc_config = self.quabo_config['maroc']
+        fields = self._maroc_fields
+        # the tags are taken from the config, so a tag changed in quabo_config directly is packed too,
+        # and the bit field of a new tag is resolved here
+        items = []
         for tag, val in maroc_config.items():
-            # Make a list of the should-be 4 ascii values
-            vals = val.split(",")
-            # Make a list of integers
-            vals_int = []
-            for i in range(len(vals)): vals_int.append(int(vals[i],0))
-            # For each tag, set the appropriate bit field
-            if (tag == "OTABG_ON"): 
-                self._set_bits_4(tag, vals_int, 0, 1)
-                self.logger.debug('OTABG_ON: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                              vals_int[2], vals_int[3]))
-            if (tag == "DAC_ON"): 
-                self._set_bits_4(tag, vals_int, 1, 1)
-                self.logger.debug('DAC_ON: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                            vals_int[2], vals_int[3]))
-            if (tag == "SMALL_DAC"): 
-                self._set_bits_4(tag, vals_int, 2, 1)
-                self.logger.debug('SMALL_DAC: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "DAC2"):
-                #need to reverse the bits
-                vals_revbits = []
-                for i in range (4):
-                    vals_revbits.append(Util.reverse_bits(int(vals[i],0),10))
-                self._set_bits_4(tag, vals_revbits, 3, 10)
-                self.logger.debug('DAC2: %d, %d, %d ,%d'%(vals_revbits[0], vals_revbits[1],
-                                                          vals_revbits[2], vals_revbits[3]))
-            if (tag == "DAC1"):
-                vals_revbits = []
-                for i in range (4):
-                    vals_revbits.append(Util.reverse_bits(int(vals[i],0),10))
-                self._set_bits_4(tag, vals_revbits, 13, 10)
-                self.logger.debug('DAC2: %d, %d, %d ,%d'%(vals_revbits[0], vals_revbits[1],
-                                                          vals_revbits[2], vals_revbits[3]))
-            if (tag == "ENB_OUT_ADC"): 
-                self._set_bits_4(tag, vals_int, 23, 1)
-                self.logger.debug('ENB_OUT_ADC: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "INV_START_GRAY"): 
-                self._set_bits_4(tag, vals_int, 24, 1)
-                self.logger.debug('INV_START_GRAY: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "RAMP8B"): 
-                self._set_bits_4(tag, vals_int, 25, 1)
-                self.logger.debug('RAMP8B: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "RAMP10B"): 
-                self._set_bits_4(tag, vals_int, 26, 1)
-                self.logger.debug('RAMP10B: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "CMD_CK_MUX"): 
-                self._set_bits_4(tag, vals_int, 155, 1)
-                self.logger.debug('CMD_CK_MUX: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "D1_D2"): 
-                self._set_bits_4(tag, vals_int, 156, 1)
-                self.logger.debug('D1_D2: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "INV_DISCR_ADC"): 
-                self._set_bits_4(tag, vals_int, 157, 1)
-                self.logger.debug('INV_DISCR_ADC: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "POLAR_DISCRI"): 
-                self._set_bits_4(tag, vals_int, 158, 1)
-                self.logger.debug('POLAR_DISCRI: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "ENB3ST"): 
-                self._set_bits_4(tag, vals_int, 159, 1)
-                self.logger.debug('ENB3ST: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "VAL_DC_FSB2"): 
-                self._set_bits_4(tag, vals_int, 160, 1)
-                self.logger.debug('VAL_DC_FSB2: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB2_50F"): 
-                self._set_bits_4(tag, vals_int, 161, 1)
-                self.logger.debug('SW_FSB2_50F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB2_100F"): 
-                self._set_bits_4(tag, vals_int, 162, 1)
-                self.logger.debug('SW_FSB2_100F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB2_100K"): 
-                self._set_bits_4(tag, vals_int, 163, 1)
-                self.logger.debug('SW_FSB2_100K: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB2_50K"): 
-                self._set_bits_4(tag, vals_int, 164, 1)
-                self.logger.debug('SW_FSB2_50K: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "VALID_DC_FS"): 
-                self._set_bits_4(tag, vals_int, 165, 1)
-                self.logger.debug('VALID_DC_FS: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "CMD_FSB_FSU"): 
-                self._set_bits_4(tag, vals_int, 166, 1)
-                self.logger.debug('CMD_FSB_FSU: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB1_50F"): 
-                self._set_bits_4(tag, vals_int, 167, 1)
-                self.logger.debug('SW_FSB1_50F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB1_100F"): 
-                self._set_bits_4(tag, vals_int, 168, 1)
-                self.logger.debug('SW_FSB1_100F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB1_100K"): 
-                self._set_bits_4(tag, vals_int, 169, 1)
-                self.logger.debug('SW_FSB1_100K: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSB1_50k"): 
-                self._set_bits_4(tag, vals_int, 170, 1)
-                self.logger.debug('SW_FSB1_50k: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSU_100K"): 
-                self._set_bits_4(tag, vals_int, 171, 1)
-                self.logger.debug('SW_FSU_100K: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSU_50K"): 
-                self._set_bits_4(tag, vals_int, 172, 1)
-                self.logger.debug('SMALL_DAC: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSU_25K"): 
-                self._set_bits_4(tag, vals_int, 173, 1)
-                self.logger.debug('SW_FSU_25K: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSU_40F"): 
-                self._set_bits_4(tag, vals_int, 174, 1)
-                self.logger.debug('SW_FSU_40F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_FSU_20F"): 
-                self._set_bits_4(tag, vals_int, 175, 1)
-                self.logger.debug('SW_FSU_20F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "H1H2_CHOICE"): 
-                self._set_bits_4(tag, vals_int, 176, 1)
-                self.logger.debug('H1H2_CHOICE: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "EN_ADC"): 
-                self._set_bits_4(tag, vals_int, 177, 1)
-                self.logger.debug('EN_ADC: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_SS_1200F"): 
-                self._set_bits_4(tag, vals_int, 178, 1)
-                self.logger.debug('SW_SS_1200F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_SS_600F"): 
-                self._set_bits_4(tag, vals_int, 179, 1)
-                self.logger.debug('SW_SS_600F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SW_SS_300F"): 
-                self._set_bits_4(tag, vals_int, 180, 1)
-                self.logger.debug('SW_SS_300F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "ON_OFF_SS"): 
-                self._set_bits_4(tag, vals_int, 181, 1)
-                self.logger.debug('ON_OFF_SS: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SWB_BUF_2P"): 
-                self._set_bits_4(tag, vals_int, 182, 1)
-                self.logger.debug('SWB_BUF_2P: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SWB_BUF_1P"): 
-                self._set_bits_4(tag, vals_int, 183, 1)
-                self.logger.debug('SWB_BUF_1P: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SWB_BUF_500F"): 
-                self._set_bits_4(tag, vals_int, 184, 1)
-                self.logger.debug('SWB_BUF_500F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "SWB_BUF_250F"): 
-                self._set_bits_4(tag, vals_int, 185, 1)
-                self.logger.debug('SWB_BUF_250F: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "CMD_FSB"):
-                self._set_bits_4(tag, vals_int, 186, 1)
-                self.logger.debug('CMD_FSB: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "CMD_SS"): 
-                self._set_bits_4(tag, vals_int, 187, 1)
-                self.logger.debug('CMD_SS: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            if (tag == "CMD_FSU"): 
-                self._set_bits_4(tag, vals_int, 188, 1)
-                self.logger.debug('CMD_FSU: %d, %d, %d ,%d'%(vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-
-            #Look for a MASKOR1 value; chan is in range 0-63, with a quad of values, one for each chip
-            if tag.startswith("MASKOR1"):
-                chan = tag.split('_')[1]
-                chan = int(chan)
-                self._set_bits_4(tag, vals_int, 154-(2*chan), 1)
-                self.logger.debug('MASKOR1_%02d: %d, %d, %d ,%d'%(chan, vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            #Look for a MASKOR2 value; chan is in range 0-63, with a quad of values, one for each chip
-            if tag.startswith("MASKOR2"):
-                chan = tag.split('_')[1]
-                chan = int(chan)
-                self._set_bits_4(tag, vals_int, 153-(2*chan), 1)
-                self.logger.debug('MASKOR2_%02d: %d, %d, %d ,%d'%(chan, vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-            #Look for a CTEST value; chan is in range 0-63, with a quad of values, one for each chip
-            if tag.startswith("CTEST"):
-                chan = tag.split('_')[1]
-                chan = int(chan)
-                #if chan in range(4):
-                    #vals_int = [0,0,0,0]
-                self._set_bits_4(tag, vals_int, 828-chan, 1)
-                self.logger.debug('CTEST_%02d: %d, %d, %d ,%d'%(chan, vals_int[0], vals_int[1],
-                                                               vals_int[2], vals_int[3]))
-                #print(tag, vals_int, chan)
-
-            #Look for a GAIN value; chan is in range 0-63, with a quad of values, one for each chip
-            if tag.startswith("GAIN"):
-                chan = tag.split('N')[1]
-                chan = int(chan)
-                #Another list, with integer values, bits reversed
-                vals_revbits = []
-                for i in range (4):
-                    vals_revbits.append(Util.reverse_bits((vals_int[i]),8))
-                self._set_bits_4(tag, vals_revbits, 757-9*chan,8)
-                self.logger.debug('GAIN%02d: %d, %d, %d ,%d'%(chan, vals_revbits[0], vals_revbits[1],
-                                                               vals_revbits[2], vals_revbits[3]))
-            for ii in range(104):
-                cmd[ii+4] = self._MAROC_regs[0][ii]
-                cmd[ii+132] = self._MAROC_regs[1][ii]
-                cmd[ii+260] = self._MAROC_regs[2][ii]
-                cmd[ii+388] = self._MAROC_regs[3][ii]
+            field = fields.get(tag)
+            if field is None:
+                self._update_maroc_field(tag)
+                field = fields.get(tag)
+                if field is None:
+                    continue
+            items.append((tag, val, field))
+        n = len(items)
+        if n == 0:
+            return
+        # the registers only depend on the maroc tags and their values,
+        # so the packed registers are reused until one of them changes
+        key = tuple((tag, val) for tag, val, field in items)
+        if self._maroc_cache is not None and self._maroc_cache[0] == key:
+            self.logger.debug('MAROC parameters are not changed')
+            regs = self._maroc_cache[1]
+        else:
+            # materialize the field metadata and the values as arrays
+            lsb = np.fromiter((f[0] for tag, val, f in items), dtype=np.int32, count=n)
+            width = np.fromiter((f[1] for tag, val, f in items), dtype=np.int32, count=n)
+            vals = np.empty((n, 4), dtype=np.uint16)
+            for i, (tag, val, f) in enumerate(items):
+                vals[i] = self._maroc_tag_vals(tag, val, f[2])
+            if self.logger.isEnabledFor(logging.DEBUG):
+                for i, (tag, val, f) in enumerate(items):
+                    self.logger.debug('%s: %d, %d, %d ,%d', tag, *vals[i])
+            _pack_maroc_regs(lsb, width, vals, self._MAROC_regs)
+            regs = [self._MAROC_regs[chip].tobytes() for chip in range(4)]
+            self._maroc_cache = (key, regs)
+        for chip in range(4):
+            cmd[4+128*chip:108+128*chip] = regs[chip]
 
     def SetMarocParams(self, echo = 1):
         """
@@ -1430,7 +2009,8 @@ class QuaboConfig(QuaboSock):
             - True if the reply is correct, otherwise False.
         """
         self.logger.debug('set MAROC parameters')
-        cmd = bytearray(492)
+        # the whole command is rebuilt each time, except the bytes which are always 0, so the buffer is reused
+        cmd = self._maroc_buf
         self._make_maroc_cmd(cmd, echo=echo)
         self.send(cmd)
         reply = self.recv(492)
@@ -1448,7 +2028,7 @@ class QuaboConfig(QuaboSock):
                 self.logger.error('Error: reply length is %d, but should be 492'%count)
                 return False
             else:
-                self.logger.debug('reply len from MAROC: %d'%count)
+                self.logger.debug('reply len from MAROC: %d', count)
                 for i in range(count):
                     if i >= 108 and i < 132:
                         continue
@@ -1472,8 +2052,9 @@ class QuaboConfig(QuaboSock):
             - tag(str): the tag.
             - vals(str): the values.
         """
-        self.logger.debug('configure Maroc chip: %s - %s'%(tag, vals))
+        self.logger.debug('configure Maroc chip: %s - %s', tag, vals)
         self.quabo_config['maroc'][tag] = vals
+        self._update_maroc_field(tag)
 
     def SetHv(self, status = 'on', chan = 0b1111):
         """
@@ -1484,28 +2065,28 @@ class QuaboConfig(QuaboSock):
             - chan: 4-bit binary number, each bit represents a channel.
         """
         self.logger.debug('set HV')
-        cmd = self.make_cmd(0x02)
+        cmd = self._reset_cmd(0x02)
         lsb = LSBParams['hv_setting']
         # set the hv values for the enabled channels
         if status == 'on':
             self.logger.debug('turn on HV')
-            for i in range(4):
-                if (chan & (1<<i)):
-                    val = self.quabo_config['hv']['HV_%d'%i]
-                    cmd[2*i+2] = val & 0xff
-                    cmd[2*i+3] = (val>> 8) & 0xff
-                    self.logger.debug('HV_%d: %d (%.2f V)'%(i, val, val * lsb))
-                else:
-                    cmd[2*i+2] = 0
-                    cmd[2*i+3] = 0
-                    self.logger.debug('HV_%d: %d (%.2f V)'%(i, 0, 0))
+            # -(bit) is all ones for an enabled channel, and 0 for a disabled one
+            hv = self._hv
+            vals = (hv[0] & -(chan & 1) & 0xffff,
+                    hv[1] & -((chan >> 1) & 1) & 0xffff,
+                    hv[2] & -((chan >> 2) & 1) & 0xffff,
+                    hv[3] & -((chan >> 3) & 1) & 0xffff)
+            _HV_STRUCT.pack_into(cmd, 2, *vals)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                for i, val in enumerate(vals):
+                    self.logger.debug('HV_%d: %d (%.2f V)', i, val, val * lsb)
         elif status == 'off':
+            # the HV values are already 0 in the new command
             self.logger.debug('turn off HV')
-            for i in range(4):
-                if (chan & (1<<i)):
-                    cmd[2*i+2] = 0
-                    cmd[2*i+3] = 0
-                    self.logger.debug('HV_%d: %d (%.2f V)'%(i, 0, 0))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                for i in range(4):
+                    if (chan & (1<<i)):
+                        self.logger.debug('HV_%d: %d (%.2f V)', i, 0, 0)
         self.flush_rx_buf()
         self.send(cmd)
 
@@ -1517,8 +2098,9 @@ class QuaboConfig(QuaboSock):
             - chan(int): the channel number.
             - value(int): the high voltage value.
         """
-        self.logger.debug('configure HV: HV_%d - %d'%(chan, value))
+        self.logger.debug('configure HV: HV_%d - %d', chan, value)
         self.quabo_config['hv']['HV_%d'%chan] = value
+        self._hv[chan] = value
 
     def _parse_trigger_parameters(self, cmd):
         """
@@ -1527,16 +2109,36 @@ class QuaboConfig(QuaboSock):
         Inputs:
             - cmd(bytearray): the command array stored the parsed channel mask parameters.
         """
+        vals = self._chanmask_vals
+        # each channel mask is a little-endian 32-bit word
+        if self._chanmask_struct is not None:
+            self._chanmask_struct.pack_into(cmd, 4, *vals)
+        else:
+            for (ch, tag), val in zip(self._chanmask_index, vals):
+                _U32_STRUCT.pack_into(cmd, 4+ch*4, val)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for (ch, tag), val in zip(self._chanmask_index, vals):
+                self.logger.debug('CHANMASK_%d: 0x%x', ch, val)
+
+    def _set_chanmask_index(self, index):
+        """
+        Description:
+            set the (channel, tag) of the CHANMASK tags.
+            The masks are usually CHANMASK_0 to CHANMASK_n, which are packed by one struct;
+            otherwise they are packed one by one.
+        Inputs:
+            - index(list): the sorted (channel, tag) of the CHANMASK tags.
+        """
+        self._chanmask_index = index
+        # the mask values in the same order, which are kept in sync with quabo_config by TriggerMaskConfig.
+        # the values in the config file are hex strings, and TriggerMaskConfig sets int values
         chanmask = self.quabo_config['chanmask']
-        for tag, val in chanmask.items():
-            if(tag.startswith('CHANMASK')):
-                ch = tag.split('_')[1]
-                ch = int(ch)
-                # only hex string is supported
-                val = int(val, 16)
-                for j in range(4): 
-                    cmd[4+ch*4+j] = (val>>j*8) & 0xff
-                    self.logger.debug('CHANMASK_%d: 0x%x'%val)
+        self._chanmask_vals = [int(chanmask[tag], 16) if isinstance(chanmask[tag], str) else chanmask[tag]
+                               for ch, tag in index]
+        if [ch for ch, tag in index] == list(range(len(index))):
+            self._chanmask_struct = struct.Struct('<%dI'%len(index))
+        else:
+            self._chanmask_struct = None
 
     def SetTriggerMask(self):
         """"
@@ -1544,8 +2146,8 @@ class QuaboConfig(QuaboSock):
             send the trigger mask parameters to the quabo.
         """
         self.logger.debug('set trigger mask')
-        cmd = self.make_cmd(0x06)
-        self._parse_chanmask_parameters(cmd)
+        cmd = self._reset_cmd(0x06)
+        self._parse_trigger_parameters(cmd)
         self.flush_rx_buf()
         self.send(cmd)
 
@@ -1557,8 +2159,15 @@ class QuaboConfig(QuaboSock):
             - chan(int): the channel number.
             - value(int): the value of the parameter.
         """
-        self.logger.debug('configure chanmask: CHANMASK_%d - 0x%x'%(chan, value))
-        self.quabo_config['chanmask']['CHANMASK_%d'%chan] = value
+        self.logger.debug('configure chanmask: CHANMASK_%d - 0x%x', chan, value)
+        tag = 'CHANMASK_%d'%chan
+        chanmask = self.quabo_config['chanmask']
+        new_tag = tag not in chanmask
+        chanmask[tag] = value
+        if new_tag:
+            self._set_chanmask_index(sorted(self._chanmask_index + [(chan, tag)]))
+        else:
+            self._chanmask_vals[self._chanmask_index.index((chan, tag))] = value
 
     def _parse_goe_mask_parameters(self, cmd):
         """"
@@ -1567,12 +2176,14 @@ class QuaboConfig(QuaboSock):
         Inputs:"
             - cmd(bytearray): the command array stored the parsed goe mask parameters.
         """
-        chanmask = self.quabo_config['chanmask']
-        for tag, val in chanmask.items():
-            if(tag == 'GOEMASK'):
-                val = int(val, 16)
-                cmd[4] = val & 0x03
-                self.logger.debug('GOEMASK: 0x%x'%val)
+        val = self.quabo_config['chanmask'].get('GOEMASK')
+        if val is None:
+            return
+        # the value in the config file is a hex string, and GoeMaskConfig sets an int value
+        if isinstance(val, str):
+            val = int(val, 16)
+        cmd[4] = val & 0x03
+        self.logger.debug('GOEMASK: 0x%x', val)
 
     def SetGoeMask(self):
         """
@@ -1580,7 +2191,7 @@ class QuaboConfig(QuaboSock):
             send the goe mask parameters to the quabo.
         """
         self.logger.debug('set GOE mask')
-        cmd = self.make_cmd(0x0e)
+        cmd = self._reset_cmd(0x0e)
         self._parse_goe_mask_parameters(cmd)
         self.flush_rx_buf()
         self.send(cmd)
@@ -1593,7 +2204,7 @@ class QuaboConfig(QuaboSock):
             - value(int): the value of the parameter.
         """
         # TODO: check if the value is valid
-        self.logger.debug('configure GOE mask: GOE - 0x%x'%value)
+        self.logger.debug('configure GOE mask: GOE - 0x%x', value)
         self.quabo_config['chanmask']['GOEMASK'] = value
 
     def _parse_acq_parameters(self, cmd):
@@ -1604,49 +2215,36 @@ class QuaboConfig(QuaboSock):
             - cmd(bytearray): the command arrary stored the parsed acq paramters.
         """
         acq = self.quabo_config['acq']
-        # convert the values to int, in case the values are strs
-        for k, v in acq.items():
-            acq[k] = int(v, 0)
-        cmd[2] = acq['ACQMODE'] & 0xff
-        self.logger.debug('ACQMODE: 0x%x'% cmd[2])
-        cmd[3] = (acq['ACQMODE'] >> 8) & 0xff
-        cmd[4] = acq['ACQINT'] & 0xff
-        cmd[5] = (acq['ACQINT'] >> 8) & 0xff
-        self.logger.debug('ACQINT: %d'%(cmd[4] + cmd[5]*256))
-        cmd[6] = acq['HOLD1'] & 0xff
-        self.logger.debug('HOLD1: %d'%cmd[6])
-        cmd[7] = (acq['HOLD1'] >> 8) & 0xff
-        cmd[8] = acq['HOLD2'] & 0xff
-        self.logger.debug('HOLD2: %d'%cmd[8])
-        cmd[9] = (acq['HOLD2'] >> 8) & 0xff
-        cmd[10] = acq['ADCCLKPH'] & 0xff
-        self.logger.debug('ADCCLKPH: %d'%cmd[10])
-        cmd[11] = (acq['ADCCLKPH'] >> 8) & 0xff
-        cmd[12] = acq['MONCHAN'] & 0xff
-        self.logger.debug('MONCHAN: %d'%cmd[12])
-        cmd[13] = (acq['MONCHAN'] >> 8) & 0xff
-        cmd[14] = acq['STIMON'] & 0x01
-        self.logger.debug('STIMON: %d'%cmd[14])
-        cmd[15] = 0
-        cmd[16] = acq['STIM_LEVEL'] & 0xff
-        self.logger.debug('STIM_LEVEL: %d'%cmd[16])
-        cmd[17] = 0
-        cmd[18] = acq['STIM_RATE'] & 0x07
-        self.logger.debug('STIM_RATE: %d'%cmd[18])
-        cmd[19] = 0
-        #cmd[20] = acq['EN_WR_UART'] & 0x01
-        # EN_WR_UART is not used in the config file, so set it to 0
-        cmd[20] = 0
-        cmd[21] = 0
-        cmd[22] = acq['FLASH_RATE'] & 0x07
-        self.logger.debug('FLASH_RATE: %d'%cmd[22])
-        cmd[23] = 0
-        cmd[24] = acq['FLASH_LEVEL'] & 0x1f
-        self.logger.debug('FLASH_LEVEL: %d'%cmd[24])
-        cmd[25] = 0
-        cmd[26] = acq['FLASH_WIDTH'] & 0x0f
-        self.logger.debug('FLASH_WIDTH: %d'%cmd[26])
-        cmd[27] = 0
+        # the values are converted to int when they are loaded or configured,
+        # and the fields missing in the config file are set to 0.
+        # EN_WR_UART is not used in the config file, so it's always 0
+        _ACQ_STRUCT.pack_into(cmd, 2,
+                              acq.get('ACQMODE', 0) & 0xffff,
+                              acq.get('ACQINT', 0) & 0xffff,
+                              acq.get('HOLD1', 0) & 0xffff,
+                              acq.get('HOLD2', 0) & 0xffff,
+                              acq.get('ADCCLKPH', 0) & 0xffff,
+                              acq.get('MONCHAN', 0) & 0xffff,
+                              acq.get('STIMON', 0) & 0x01,
+                              acq.get('STIM_LEVEL', 0) & 0xff,
+                              acq.get('STIM_RATE', 0) & 0x07,
+                              0,
+                              acq.get('FLASH_RATE', 0) & 0x07,
+                              acq.get('FLASH_LEVEL', 0) & 0x1f,
+                              acq.get('FLASH_WIDTH', 0) & 0x0f)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('ACQMODE: 0x%x', cmd[2])
+            self.logger.debug('ACQINT: %d', cmd[4] + cmd[5]*256)
+            self.logger.debug('HOLD1: %d', cmd[6])
+            self.logger.debug('HOLD2: %d', cmd[8])
+            self.logger.debug('ADCCLKPH: %d', cmd[10])
+            self.logger.debug('MONCHAN: %d', cmd[12])
+            self.logger.debug('STIMON: %d', cmd[14])
+            self.logger.debug('STIM_LEVEL: %d', cmd[16])
+            self.logger.debug('STIM_RATE: %d', cmd[18])
+            self.logger.debug('FLASH_RATE: %d', cmd[22])
+            self.logger.debug('FLASH_LEVEL: %d', cmd[24])
+            self.logger.debug('FLASH_WIDTH: %d', cmd[26])
 
     def SetAcqParams(self):
         """"
@@ -1654,7 +2252,7 @@ class QuaboConfig(QuaboSock):
             send the acquisition parameters to the quabo.
         """
         self.logger.debug('set acq parameters')
-        cmd = self.make_cmd(0x03)
+        cmd = self._reset_cmd(0x03)
         self._parse_acq_parameters(cmd)
         self.flush_rx_buf()
         self.send(cmd)
@@ -1665,9 +2263,10 @@ class QuaboConfig(QuaboSock):
             set the acquisition parameters.
         Inputs:
             - key(str): the key of the parameter.
-            - value(int): the value of the parameter.
+            - value(int or str): the value of the parameter.
         """
-        self.logger.debug('configure acq param: %s - %d'%(key, value))
+        value = _to_int(value)
+        self.logger.debug('configure acq param: %s - %d', key, value)
         self.quabo_config['acq'][key] = value
         
     def Reset(self):
@@ -1678,7 +2277,7 @@ class QuaboConfig(QuaboSock):
             this command may not be valid currently.
         """
         self.logger.debug('reset the quabo')
-        cmd = self.make_cmd(0x04)
+        cmd = self._reset_cmd(0x04)
         self.send(cmd)
 
     def SetFocus(self, steps):
@@ -1691,25 +2290,10 @@ class QuaboConfig(QuaboSock):
         """
         # TODO: we don't have enough information about this command??
         # what does endzone, backoff...mean?
-        self.logger.debug('set focus: steps - %d'%steps)
-        endzone = 300
-        backoff = 200
-        step_ontime = 10000
-        step_offtime = 10000
-
-        cmd = self.make_cmd(0x05)
-        cmd[4] = steps & 0xff
-        cmd[5] = (steps >> 8)&0xff
-        cmd[6] = self._shutter_open | (self._shutter_power<<1)
-        cmd[8] = self._fanspeed
-        cmd[10] = endzone & 0xff
-        cmd[11] = (endzone>>8) & 0xff
-        cmd[12] = backoff & 0xff
-        cmd[13] = (backoff>>8) & 0xff
-        cmd[14] = step_ontime & 0xff
-        cmd[15] = (step_ontime>>8) & 0xff
-        cmd[16] = step_offtime & 0xff
-        cmd[17] = (step_offtime>>8) & 0xff
+        self.logger.debug('set focus: steps - %d', steps)
+        cmd = self._reset_cmd(0x05)
+        _FOCUS_STRUCT.pack_into(cmd, 4, steps & 0xffff, self._shutter_byte, self._fanspeed,
+                                *QuaboConfig.FOCUS_PARAMS)
         self.send(cmd)
 
     def SetShutter(self, closed):
@@ -1721,18 +2305,15 @@ class QuaboConfig(QuaboSock):
         """
         # TODO: we don't have enough information about this command??
         # TODO: Do we still use this command?
-        self.logger.debug('set shutter: status - %d'%closed)
-        cmd = self.make_cmd(0x05)
-        self._shutter_open = 0 if closed else 1
-        self._shutter_power = 1
-        cmd[6] = self._shutter_open | (self._shutter_power<<1)
-        cmd[8] = self._fanspeed
+        self.logger.debug('set shutter: status - %d', closed)
+        cmd = self._reset_cmd(0x05)
+        # power on the shutter, and then power it off after 1s
+        self._shutter_byte = (0 if closed else 1) | 0x02
+        _SHUTTER_FAN_STRUCT.pack_into(cmd, 6, self._shutter_byte, self._fanspeed)
         self.send(cmd)
         time.sleep(1)
-        self._shutter_open = 0
-        self._shutter_power = 0
-        cmd[6] = self._shutter_open | (self._shutter_power<<1)
-        cmd[8] = self._fanspeed
+        self._shutter_byte = 0
+        cmd[6] = self._shutter_byte
         self.send(cmd)
 
     def SetFan(self, fanspeed):     # fanspeed is 0..15
@@ -1743,12 +2324,11 @@ class QuaboConfig(QuaboSock):
             - fanspeed(int): the fan speed. 
                              valid range is 0-15.
         """
-        self.logger.debug('set fan: fanspeed - %d'%fanspeed)
+        self.logger.debug('set fan: fanspeed - %d', fanspeed)
         # TODO: we don't have enough information about this command??
         self._fanspeed = fanspeed
-        cmd = self.make_cmd(0x85)
-        cmd[6] = self._shutter_open | (self._shutter_power<<1)
-        cmd[8] = self._fanspeed
+        cmd = self._reset_cmd(0x85)
+        _SHUTTER_FAN_STRUCT.pack_into(cmd, 6, self._shutter_byte, self._fanspeed)
         self.send(cmd)
         time.sleep(1)
         self.flush_rx_buf()
@@ -1760,8 +2340,8 @@ class QuaboConfig(QuaboSock):
         Inputs:
             - closed(bool): whether to close the shutter.
         """
-        self.logger.debug('set shutter(new): status - %d'%closed)
-        cmd = self.make_cmd(0x08)
+        self.logger.debug('set shutter(new): status - %d', closed)
+        cmd = self._reset_cmd(0x08)
         cmd[1] = 0x01 if closed else 0x0
         self.send(cmd)
 
@@ -1772,29 +2352,76 @@ class QuaboConfig(QuaboSock):
         Inputs:
             - val(bool): whether to turn on the led flash
         """
-        self.logger.debug('set led flasher: status - %d'%val)
-        cmd = self.make_cmd(0x09)
+        self.logger.debug('set led flasher: status - %d', val)
+        cmd = self._reset_cmd(0x09)
         cmd[1] = 0x01 if val else 0x0
         self.send(cmd)
 
-    def CalPhBaseline(self):
+    def CalPhBaseline(self, as_array=False):
         """
         Description:
             calibrate the pulse height baseline.
+        Inputs:
+            - as_array(bool): return the baselines as a numpy array, which is ready for the numpy checks.
+        Outputs:
+            - x(list or np.ndarray): the baselines of the 256 channels.
         """
         self.logger.debug('cal PH baseline')
-        cmd = self.make_cmd(0x07)
+        cmd = self._reset_cmd(0x07)
+        # in batched(), the queued commands are sent before the flush, the same as outside of it
+        self._send_pending()
         self.flush_rx_buf()
         self.send(cmd)
-        time.sleep(2)
+        # the reply is read from the socket directly, so the command queued by batched() is sent here
+        self._send_pending()
+        # the calibration takes up to 2 seconds, so wait for the reply instead of sleeping for 2 seconds.
+        # recvfrom still waits for the socket timeout after that, the same as before
+        select.select([self.sock], [], [], 2)
         reply = self.sock.recvfrom(1024)
         bytesback = reply[0]
-        x = []
-        for n in range(256):
-            val = bytesback[2*n+4] + 256*bytesback[2*n+5]
-            x.append(val)
+        # the baselines are 256 little-endian uint16 values after the 4-byte header
+        if as_array:
+            # copy the values out of the reply, so the array is writable
+            return np.frombuffer(bytesback, dtype='<u2', count=256, offset=4).copy()
+        x = list(_BASELINE_STRUCT.unpack_from(bytesback, 4))
         return x
 
+    def _update_config(self, cfg_keys, config_file, caller):
+        """
+        Description:
+            update the sections of the config file with the current config.
+            The file is written to a temp file first and then renamed, so it is never left half-written.
+        Inputs:
+            - cfg_keys(tuple): the sections in the config, e.g. ('dest_ips', 'maroc', 'chanmask').
+            - config_file(str): the config file path.
+            - caller(str): the name of the calling method, used in the debug message.
+        """
+        # the config written last time is reused if the file is not changed since then
+        try:
+            st = os.stat(config_file)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        cached = self._config_files.get(config_file)
+        if stamp is not None and cached is not None and cached[0] == stamp:
+            cfg = cached[1]
+        else:
+            try:
+                with open(config_file, 'rb') as f:
+                    cfg = json.load(f)
+            except (OSError, ValueError):
+                self.logger.debug('new config file created when calling `%s`', caller)
+                cfg = {}
+        # copy the sections, so the cached config is not changed with self.quabo_config
+        for cfg_key in cfg_keys:
+            cfg[cfg_key] = copy.deepcopy(self.quabo_config[cfg_key])
+        tmp_file = config_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps(cfg, indent=2))
+        os.replace(tmp_file, config_file)
+        st = os.stat(config_file)
+        self._config_files[config_file] = ((st.st_mtime_ns, st.st_size), cfg)
+
     def WriteIPsConfig(self, config_file='quabo_config.json'):
         """
         Description:
@@ -1803,15 +2430,7 @@ class QuaboConfig(QuaboSock):
             - config_file(str): the config file path.
         """
         self.logger.debug('write IPs config to a file')
-        try:
-            with open(config_file, 'rb') as f:
-                cfg = json.load(f)
-        except:
-            self.logger.debug('new config file created when calling `WriteIPsConfig`')
-            cfg = {}
-        cfg['dest_ips'] = self.quabo_config['dest_ips']
-        with open(config_file, 'w') as f:
-            json.dump(cfg, f, indent=2)
+        self._update_config(('dest_ips',), config_file, 'WriteIPsConfig')
 
     def WriteMarocConfig(self, config_file='quabo_config.json'):
         """
@@ -1821,15 +2440,7 @@ class QuaboConfig(QuaboSock):
             - config_file(str): the config file path.
         """
         self.logger.debug('write MAROC config to a file')
-        try:
-            with open(config_file, 'rb') as f:
-                cfg = json.load(f)
-        except:
-            self.logger.debug('new config file created when calling `WriteMarocConfig`')
-            cfg = {}
-        cfg['maroc'] = self.quabo_config['maroc']
-        with open(config_file, 'w') as f:
-            json.dump(cfg, f, indent=2)
+        self._update_config(('maroc',), config_file, 'WriteMarocConfig')
     
     def WriteMaskConfig(self,  config_file='quabo_config.json'):
         """
@@ -1839,16 +2450,19 @@ class QuaboConfig(QuaboSock):
             - config_file(str): the config file path.
         """
         self.logger.debug('write mask config to a file')
-        try:
-            with open(config_file, 'rb') as f:
-                cfg = json.load(f)
-        except:
-            self.logger.debug('new config file created when calling `WriteMaskConfig`')
-            cfg = {}
-        # create the tag list
-        cfg['chanmask'] = self.quabo_config['chanmask']
-        with open(config_file, 'w') as f:
-            json.dump(cfg, f, indent=2)
+        self._update_config(('chanmask',), config_file, 'WriteMaskConfig')
+
+    def WriteConfig(self, config_file='quabo_config.json', sections=('dest_ips', 'maroc', 'chanmask')):
+        """
+        Description:
+            write several sections of the config to the config file at once,
+            so the file is only read and written once, instead of once for each Write*Config call.
+        Inputs:
+            - config_file(str): the config file path.
+            - sections(tuple): the sections to write, e.g. 'dest_ips', 'maroc' or 'chanmask'.
+        """
+        self.logger.debug('write %s config to a file', ', '.join(sections))
+        self._update_config(tuple(sections), config_file, 'WriteConfig')
 
 class HKRecv(QuaboSock):
     """
@@ -1869,8 +2483,8 @@ class HKRecv(QuaboSock):
         super().__init__(ip_addr, HKRecv.PORTS['HK'],timeout=timeout)
         self.logger = logging.getLogger('%s.HKRecv'%logger)
         self.logger.setLevel(logging.DEBUG)
-        self.logger.debug('Init HKRecv class - IP: %s'%ip_addr)
-        self.logger.debug('Init HKRecv class - PORT: %d'%HKRecv.PORTS['HK'])
+        self.logger.debug('Init HKRecv class - IP: %s', ip_addr)
+        self.logger.debug('Init HKRecv class - PORT: %d', HKRecv.PORTS['HK'])
         self.data = None
         self.timestamp = None
     
@@ -1882,20 +2496,24 @@ class HKRecv(QuaboSock):
             - n(int): the number of packets to receive.
         """
         self.logger.debug('receive HK data')
-        self.data = np.zeros(n, dtype=object)
-        self.timestamp = np.zeros(n, dtype=float)
+        # the packets are kept in a list, and the lost packets are left as None
+        self.data = [None]*n
+        self.timestamp = np.zeros(n, dtype=np.float64)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         for i in range(n):
             try:
                 recv, addr = self.sock.recvfrom(HKRecv.PKTLEN)
             except Exception as e:
                 self.logger.error('Error receiving HK data: %s'%e)
+                continue
             if addr[0] != self.ip_addr:
                 self.data = None
                 return None, None
-            timestamp = datetime.now()
-            self.logger.debug('HK data received at %s'%timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+            timestamp = time.time()
+            if debug:
+                self.logger.debug('HK data received at %s', datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'))
             self.data[i] = recv
-            self.timestamp[i] = timestamp.timestamp()
+            self.timestamp[i] = timestamp
 
     def ParseData(self):
         """
@@ -1907,68 +2525,25 @@ class HKRecv(QuaboSock):
         if self.data is None:
             self.logger.error('Error: Failed to parse HK data, which is None')
             return None
-        parsed_data = np.zeros(len(self.data), dtype=object)
+        n = len(self.data)
+        parsed_data = [None]*n
         self.logger.debug('parse HK data')
-        for i in range(len(self.data)):
-        # parse the housekeeping data here
-            hk_data = {}
-            hk_data['timestamp'] = self.timestamp[i]
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        valid = []
+        for i in range(n):
             if self.data[i] is None:
                 self.logger.warning('Error: HK data is None')
-                continue
-            for k, v in HKPktDef.items():
-                self.logger.debug('key: %s'%k)
-                offset = v['offset']
-                self.logger.debug('offset: %d'%offset)
-                length = v['length']
-                self.logger.debug('length: %d'%length)
-                flag = DType[v['type']]['flag']
-                self.logger.debug('flag: %s'%flag)
-                size = DType[v['type']]['size']
-                self.logger.debug('size: %d'%size)
-                dtype = '<%d%s'%(length/size, flag)
-                self.logger.debug('dtype: %s'%dtype)
-                d = self.data[i][offset:offset+length]
-                # deal with some special cases
-                if k == 'uid' or k == 'fwtime':
-                    r = struct.unpack(dtype, d)[0]
-                    self.logger.debug('%s: %s'%(k, hex(r)))
-                    hk_data[k] = r
-                    continue
-                if k == 'fwver':
-                    r = struct.unpack(dtype, d)[0].decode('utf-8')[::-1]
-                    self.logger.debug('%s: %s'%(k, r))
-                    hk_data[k] = r
-                    continue
-                if k == 'boardloc':
-                    r = struct.unpack(dtype, d)[0]
-                    hk_data[k] = '192.168.%d.%d'%(r>>8, r&0xff)
-                    self.logger.debug('%s: %s'%(k, hk_data[k]))
-                    continue
-                # for other cases
-                # not all of the structs have lsb, constant, bit
-                try:
-                    lsb = v['lsb']
-                except:
-                    lsb = 1
-                try:
-                    constant = v['constant']
-                except:
-                    constant = 0
-                try:
-                    bit = v['bit']
-                except:
-                    bit = None
-                # start to parse hk data
-                if length == 1 and bit is None:
-                    hk_data[k] = self.data[i][offset]
-                elif length == 1 and bit is not None:
-                    hk_data[k] = (self.data[i][offset] >> bit) & 0x01
-                else:
-                    r = struct.unpack(dtype, d)[0]
-                    self.logger.debug('k: %s, r: %d, constant: %d'%(k, r, constant))
-                    hk_data[k] = r * lsb + constant
-                self.logger.debug('%s: %s'%(k, hk_data[k]))
+            else:
+                valid.append(i)
+        if len(valid) == 0:
+            return parsed_data
+        for i, fields in zip(valid, _parse_hk_pkts([self.data[i] for i in valid])):
+            hk_data = {}
+            hk_data['timestamp'] = self.timestamp[i]
+            hk_data.update(fields)
+            if debug:
+                for k, v in hk_data.items():
+                    self.logger.debug('%s: %s', k, v)
             parsed_data[i] = hk_data
         return parsed_data
     
@@ -1979,11 +2554,11 @@ class HKRecv(QuaboSock):
         Inputs:
             - filename(str): the file name.
         """
-        self.logger.debug('dump HK data to %s'%filename)
+        self.logger.debug('dump HK data to %s', filename)
         datadir = os.path.dirname(filename)
         if not os.path.exists(datadir):
             os.makedirs(datadir)
-        np.savez(filename, data=self.data, timestamp=self.timestamp)
+        np.savez(filename, data=np.array(self.data, dtype=object), timestamp=self.timestamp)
 
 class DataRecv(QuaboSock):
     """
@@ -1997,7 +2572,8 @@ class DataRecv(QuaboSock):
          '8bit': 272,
          '16bit': 528    
     }
-    RECVBUFFSIZE = 212992
+    # the kernel caps SO_RCVBUF at net.core.rmem_max, so SO_RCVBUFFORCE is tried first
+    RECVBUFFSIZE = 16 << 20
     def __init__(self, ip_addr, timeout=0.5, logger='Quabo'):
         """
         Description:
@@ -2008,12 +2584,53 @@ class DataRecv(QuaboSock):
             - logger(str): the logger name.
         """
         super().__init__(ip_addr, DataRecv.PORTS['DATA'])
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DataRecv.RECVBUFFSIZE)
         self.logger = logging.getLogger('%s.DataRecv'%logger)
-        self.logger.debug('Init DataRecv class - IP: %s'%ip_addr)
-        self.logger.debug('Init DataRecv class - PORT: %d'%DataRecv.PORTS['DATA'])
+        rcvbuf = self._set_recv_buff(DataRecv.RECVBUFFSIZE)
+        self.logger.debug('Init DataRecv class - RCVBUF: %d', rcvbuf)
+        self.logger.debug('Init DataRecv class - IP: %s', ip_addr)
+        self.logger.debug('Init DataRecv class - PORT: %d', DataRecv.PORTS['DATA'])
         self.data = None
         self.timestamp = None
+        # the buffers used by _recv_batch, which are reused by the following RecvData calls
+        self._batch_bufs = None
+        # the kernel time of each packet is used as its timestamp with recvmmsg,
+        # because all the packets of one recvmmsg call are received at the same time
+        self._kernel_ts = False
+        if _recvmmsg is not None:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMP, 1)
+                self._kernel_ts = True
+            except OSError:
+                pass
+        # the buffer used by the recvfrom loop, when recvmmsg is not available
+        self._recv_buf = memoryview(bytearray(max(DataRecv.PKTLEN.values())))
+
+    def DrainData(self, duration):
+        """
+        Description:
+            discard the packets received in the given time, so the following RecvData starts with
+            the packets sent after that.
+        Inputs:
+            - duration(float): the time to drain the socket, in seconds.
+        Outputs:
+            - n(int): the number of the packets discarded.
+        """
+        n = 0
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([self.sock], [], [], remaining)
+            if not ready:
+                continue
+            try:
+                self.sock.recv_into(self._recv_buf)
+            except OSError:
+                continue
+            n += 1
+        self.logger.debug('Drain science data - %d packets discarded', n)
+        return n
 
     def RecvData(self, n=1, mode='16bit'):
         """
@@ -2024,33 +2641,120 @@ class DataRecv(QuaboSock):
             - mode(str): the mode of the data, '8bit' or '16bit'.
         """
         self.logger.debug('receive science data')
-        self.data = np.zeros(n, dtype=object)
-        self.timestamp = np.zeros(n, dtype=float)
+        # the packets are kept in a list, and the lost packets are left as None
+        self.data = [None]*n
+        self.timestamp = np.zeros(n, dtype=np.float64)
+        if _recvmmsg is not None:
+            return self._recv_batch(n, DataRecv.PKTLEN[mode])
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        buf = self._recv_buf[:DataRecv.PKTLEN[mode]]
         for i in range(n):
             try:
-                recv, addr = self.sock.recvfrom(DataRecv.PKTLEN[mode])
+                nbytes, addr = self.sock.recvfrom_into(buf)
             except Exception as e:
                 self.logger.error('Error receiving Science data: %s'%e)
+                continue
             if addr[0] != self.ip_addr:
                 self.data = None
                 return None, None
-            timestamp = datetime.now()
-            self.logger.debug('Science data received at %s'%timestamp.strftime('%Y-%m-%d %H:%M:%S'))
-            self.data[i] = recv
-            self.timestamp[i] = timestamp.timestamp()
+            timestamp = time.time()
+            if debug:
+                self.logger.debug('Science data received at %s', datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'))
+            self.data[i] = bytes(buf[:nbytes])
+            self.timestamp[i] = timestamp
+
+    def _get_batch_bufs(self, n, pktlen):
+        """
+        Description:
+            get the buffers and the mmsghdr array for receiving n packets with recvmmsg.
+            The buffers are only allocated when there are not enough of them, or the packet length changes.
+        Inputs:
+            - n(int): the number of packets to receive.
+            - pktlen(int): the max length of each packet.
+        Outputs:
+            - msgs(ctypes array): the mmsghdr array.
+            - raw(memoryview): the packet buffers, pktlen bytes for each packet.
+            - raw_names(memoryview): the source addresses, a sockaddr_in for each packet.
+            - raw_ctrl(memoryview): the control messages, _CMSG_TIMESTAMP_SPACE bytes for each packet.
+        """
+        if self._batch_bufs is not None:
+            size, length, msgs, raw, raw_names, _, raw_ctrl = self._batch_bufs
+            if size >= n and length == pktlen:
+                return msgs, raw, raw_names, raw_ctrl
+        self._batch_bufs = (n, pktlen) + _alloc_mmsg(n, pktlen, _CMSG_TIMESTAMP_SPACE)
+        return self._batch_bufs[2:5] + self._batch_bufs[6:]
+
+    def _recv_batch(self, n, pktlen):
+        """
+        Description:
+            receive the data from the quabo with recvmmsg, so several packets are received in one syscall.
+            The timestamp of each packet is the time the kernel received it(SO_TIMESTAMP),
+            or the time of the syscall if it is not available.
+        Inputs:
+            - n(int): the number of packets to receive.
+            - pktlen(int): the max length of each packet.
+        """
+        msgs, raw, raw_names, raw_ctrl = self._get_batch_bufs(n, pktlen)
+        # the kernel writes the length of the control messages back, so it is reset for every packet
+        for j in range(n):
+            msgs[j].msg_hdr.msg_controllen = _CMSG_TIMESTAMP_SPACE
+        kernel_ts = self._kernel_ts
+        fd = self.sock.fileno()
+        timeout = self.sock.gettimeout()
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        # compare the raw source address(sin_addr in sockaddr_in) with the quabo ip bytes
+        ip_bytes = _resolve_ipbytes(self.ip_addr)
+        i = 0
+        while i < n:
+            # read the queued packets first, and only wait with select when there is nothing queued,
+            # so there is one syscall per batch when the packets come in quickly
+            got = _recvmmsg(fd, ctypes.addressof(msgs) + i * ctypes.sizeof(_mmsghdr), n - i, socket.MSG_DONTWAIT, None)
+            if got < 0:
+                e = ctypes.get_errno()
+                if e == errno.EINTR:
+                    continue
+                if e in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    ready, _, _ = select.select([fd], [], [], timeout)
+                    if not ready:
+                        self.logger.error('Error receiving Science data: timed out')
+                        i += 1
+                    continue
+                self.logger.error('Error receiving Science data: %s'%os.strerror(e))
+                i += 1
+                continue
+            timestamp = time.time()
+            if debug:
+                self.logger.debug('%d Science data received at %s', got, datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'))
+            for j in range(i, i + got):
+                if raw_names[j*_SOCKADDR_IN_LEN+4:j*_SOCKADDR_IN_LEN+8] != ip_bytes:
+                    self.data = None
+                    return None, None
+                self.data[j] = raw[j*pktlen:j*pktlen+msgs[j].msg_len].tobytes()
+                self.timestamp[j] = timestamp
+                if kernel_ts and msgs[j].msg_hdr.msg_controllen >= _CMSG_TIMESTAMP_SPACE:
+                    off = j * _CMSG_TIMESTAMP_SPACE
+                    clen, level, ctype = _CMSGHDR_STRUCT.unpack_from(raw_ctrl, off)
+                    if level == socket.SOL_SOCKET and ctype == _SO_TIMESTAMP:
+                        sec, usec = _TIMEVAL_STRUCT.unpack_from(raw_ctrl, off + _CMSG_DATA_OFFSET)
+                        self.timestamp[j] = sec + usec * 1e-6
+            i += got
 
     def ParseData(self, mode='ph'):
         """
         Description:
             parse the data received from the quabo.
         Inputs:
-            - data(bytearray): the data received from the quabo.
+            - mode(str): the mode of the data, 'ph', 'movie-16bit' or 'movie-8bit'.
+        Outputs:
+            - parsed_data(list): the parsed science data. The lost packets are skipped.
         """
         self.logger.debug('parse science data')
         if self.data is None:
             self.logger.error('Error: Failed to parse science data, which is None')
             return None
         parsed_data = []
+        parse = _sci_parser(mode)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         for i in range(len(self.data)):
             if self.data[i] is None:
                 self.logger.warning('Error: Science data is None')
@@ -2060,40 +2764,15 @@ class DataRecv(QuaboSock):
             # parse the data here
             sci_data = {}
             sci_data['timestamp'] = timestamp
-            self.logger.debug('%s: %s'%('timestamp', timestamp))
-            for k,v in DaqPktDef.items():
-                # deal with some special cases
-                if k == 'boardloc':
-                    r = struct.unpack('<H', data[0:2])[0]
-                    sci_data[k] = '192.168.%d.%d'%(r>>8, r&0xff)
-                    self.logger.debug('%s: %s'%(k, sci_data[k]))
-                    continue
-                if k == 'data':
-                    offset = v[mode]['offset']
-                    length = v[mode]['length']
-                    flag = DType[v[mode]['type']]['flag']
-                    size = DType[v[mode]['type']]['size']
-                    d = data[offset:offset+length]
-                    dtype = '<%d%s'%(length/size, flag)
-                    r = struct.unpack(dtype, d)
-                    if mode == 'ph':
-                        sci_data[k] = np.array(r, dtype=np.short)
-                    elif mode == 'movie-16bit':
-                        sci_data[k] = np.array(r, dtype=np.ushort)
-                    elif mode == 'movie-8bit':
-                        sci_data[k] = np.array(r, dtype=np.ubyte) 
-                    self.logger.debug('len(%s): %s'%(k, len(sci_data[k])))
-                    continue
-                offset = v['offset']
-                length = v['length']
-                flag = DType[v['type']]['flag']
-                size = DType[v['type']]['size']
-                d = data[offset:offset+length]
-                dtype = '<%d%s'%(length/size, flag)
-                sci_data[k] = struct.unpack(dtype, d)[0]
-                self.logger.debug('%s: %s'%(k, sci_data[k]))
+            parse(data, sci_data)
+            if debug:
+                for k, v in sci_data.items():
+                    if k == 'data':
+                        self.logger.debug('len(%s): %s', k, len(v))
+                    else:
+                        self.logger.debug('%s: %s', k, v)
             parsed_data.append(sci_data)
-        return np.array(parsed_data)
+        return parsed_data
 
     def DumpData(self, filename = 'sci_data.npz'):
         """
@@ -2102,17 +2781,32 @@ class DataRecv(QuaboSock):
         Inputs:
             - filename(str): the file name.
         """
-        self.logger.debug('dump science data to %s'%filename)
+        self.logger.debug('dump science data to %s', filename)
         datadir = os.path.dirname(filename)
         if not os.path.exists(datadir):
             os.makedirs(datadir)
-        np.savez(filename, data=self.data, timestamp=self.timestamp)
+        # the PH/movie captures are large and very redundant, so they are compressed
+        np.savez_compressed(filename, data=np.array(self.data, dtype=object), timestamp=self.timestamp)
 
 class QuaboTest(object):
     """
     Description:
         The QuaboTest class is used to test the quabo.
-    """    
+    """
+    # the messages used by CheckResults, keyed by (value format, passed, with deviation)
+    CHECK_MSGS = {
+        ('%s', False, False): 'Error: %s - expected val(%s) is not equal to actual val(%s)',
+        ('%s', True, False): 'Info: %s - expected val(%s) is equal to actual val(%s)',
+        ('%d', False, False): 'Error: %s - expected val(%d) is not equal to %d',
+        ('%d', False, True): 'Error: %s - expected val(%d)/deviation(%d) is not equal to %d',
+        ('%d', True, False): 'Info: %s - expected val(%d) is equal to actual val(%d)',
+        ('%d', True, True): 'Info: %s - expected val(%d)/deviation(%d) is equal to actual val(%d)',
+        ('%.02f', False, False): 'Error: %s - expected val(%.02f) is not equal to %.02f',
+        ('%.02f', False, True): 'Error: %s - expected val(%.02f)/deviation(%.02f) is not equal to %.02f',
+        ('%.02f', True, False): 'Info: %s - expected val(%.02f) is equal to actual val(%.02f)',
+        ('%.02f', True, True): 'Info: %s - expected val(%.02f)/deviation(%.02f) is equal to actual val(%.02f)'
+    }
+
     def __init__(self, ip_file='configs/quabo_ip.json', autotest_config_file= 'configs/autotest_config.json', expected_results_file='configs/expected_results.json', logfile='reports_quabo.log'):
         """
         Description:
@@ -2129,8 +2823,8 @@ class QuaboTest(object):
         self.autotest_config = Util.read_json(autotest_config_file)
         # read the expected results
         self.expected_results = Util.read_json(expected_results_file)
-        # get uid
-        self.uid = self.client.get_flashuid()
+        # get uid, which is usually read by run_tests.py already
+        self.uid = self.client.get_flashuid(cached=True)
         # create logger
         self.logfile = logfile
         self.logger = Util.create_logger('reports/%s/%s'%(self.uid,self.logfile), mode='w', tag='QuaboAutoTest')
@@ -2153,36 +2847,20 @@ class QuaboTest(object):
             e_val = v['val']
             e_offset = v['deviation']
             a_val = actual_results[k]
-            if type(e_val) == str:
-                if e_val != a_val:
-                    passed = False
-                    self.logger.error('Error: %s - expected val(%s) is not equal to acutal val(%s)'%(k, e_val, a_val))
-                else:
-                    self.logger.info('Info: %s - expected val(%s) is equal to actual val(%s)'%(k, e_val, a_val))
+            if isinstance(e_val, str):
+                fmt = '%s'
+                ok = e_val == a_val
             else:
-                if abs(e_val) - e_offset > abs(a_val) or abs(e_val) + e_offset < abs(a_val):
-                    passed = False
-                    if type(e_val) == int:
-                        if e_offset == 0:
-                            self.logger.error('Error: %s - expected val(%d) is not equal to %d'%(k, e_val, a_val))
-                        else:
-                            self.logger.error('Error: %s - expected val(%d)/deviation(%d) is not equal to %d'%(k, e_val, e_offset, a_val))
-                    elif type(e_val) == float:
-                        if e_offset == 0:
-                            self.logger.error('Error: %s - expected val(%.02f) is not equal to %.02f'%(k, e_val, a_val))
-                        else:
-                            self.logger.error('Error: %s - expected val(%.02f)/deviation(%.02f) is not equal to %.02f'%(k, e_val, e_offset, a_val))
-                else:
-                    if type(e_val) == int:
-                        if e_offset == 0:
-                            self.logger.info('Info: %s - expected val(%d) is equal to actual val(%d)'%(k, e_val, a_val))
-                        else:
-                            self.logger.info('Info: %s - expected val(%d)/deviation(%d) is equal to actual val(%d)'%(k, e_val, e_offset, a_val))
-                    elif type(e_val) == float:
-                        if e_offset == 0:
-                            self.logger.info('Info: %s - expected val(%.02f) is equal to actual val(%.02f)'%(k, e_val, a_val))
-                        else:
-                            self.logger.info('Info: %s - expected val(%.02f)/deviation(%.02f) is equal to actual val(%.02f)'%(k, e_val, e_offset, a_val))
+                fmt = '%d' if isinstance(e_val, int) else '%.02f'
+                ok = abs(e_val) - e_offset <= abs(a_val) <= abs(e_val) + e_offset
+            # the deviation is only reported for the numbers
+            dev = fmt != '%s' and e_offset != 0
+            args = (k, e_val, e_offset, a_val) if dev else (k, e_val, a_val)
+            if ok:
+                self.logger.info(QuaboTest.CHECK_MSGS[fmt, ok, dev], *args)
+            else:
+                passed = False
+                self.logger.error(QuaboTest.CHECK_MSGS[fmt, ok, dev], *args)
         return passed
 
     def CheckHKPktVals(self):
@@ -2295,14 +2973,14 @@ class QuaboTest(object):
         self.logger.info('PH destination IP address: %s'%ph_dest_ip)
         ph_mac_local = Util.get_mac_by_ip(ph_dest_ip)
         self.logger.info('PH MAC address got on local machine: %s'%ph_mac_local)
-        ph_mac_quabo = ":".join("{:02x}".format(b) for b in macs['PH'])
+        ph_mac_quabo = bytes(macs['PH']).hex(':')
         self.logger.info('PH MAC address got on Quabo: %s'%ph_mac_quabo)
         # get the destination MAC address for Movie packets
         movie_dest_ip = quabo_config['dest_ips']['MOVIE']
         self.logger.info('Movie destination IP address: %s'%movie_dest_ip)
         movive_mac_local = Util.get_mac_by_ip(movie_dest_ip)
         self.logger.info('Movie MAC address got on local machine: %s'%movive_mac_local)
-        movie_mac = ":".join("{:02x}".format(b) for b in macs['MOVIE'])
+        movie_mac = bytes(macs['MOVIE']).hex(':')
         self.logger.info('Movie MAC address got on Quabo: %s'%movie_mac)
         if ph_mac_local == ph_mac_quabo and movive_mac_local == movie_mac:
             self.logger.info('Destination MAC address is correct')
@@ -2359,10 +3037,7 @@ class QuaboTest(object):
         # dump the data
         qcd.DumpData('reports/%s/quabo/wr_timing.npz'%self.uid)
         # check the timestamps
-        timestamps = []
-        for d in qcdpkt:
-            timestamps.append(d['nanosec'])
-        timestamps = np.array(timestamps)
+        timestamps = np.fromiter((d['nanosec'] for d in qcdpkt), dtype=np.int64, count=len(qcdpkt))
         passed = True
         # check the max timestamps
         max_timestamps = np.max(timestamps)
@@ -2370,14 +3045,9 @@ class QuaboTest(object):
             passed = False
             self.logger.error('Error: White Rabbit timestamp - max timestamp(%d) is greater than 1 second'%max_timestamps)
         # calculate the timestamps difference
-        tdiff = []
-        for i in range(len(timestamps)-1):
-            t0 = timestamps[i]
-            t1 = timestamps[i+1]
-            if t1 < t0:
-                t1 += 10**9
-            tdiff.append(t1 - t0)
-        tdiff = np.array(tdiff)
+        # the nanosec wraps around every second
+        tdiff = np.diff(timestamps)
+        tdiff[tdiff < 0] += 10**9
         # check the max timestamps difference
         if np.max(tdiff) != integration_time*10**3:
             passed = False
@@ -2421,6 +3091,68 @@ class SiPMSimTest(QuaboTest):
         # create logger
         self.logger = Util.create_logger('reports/%s/reports_sipm_%s.log'%(self.uid, self.connector), mode='w', tag='SiPMSimTest')
         self.logger.info('Quabo UID - %s'%self.uid)
+        # the PH captures, which are shared by the checks using the same acquisition
+        self._ph_cache = {}
+
+    def _AcquirePH(self, npkt, check, hv_after_warmup=False):
+        """
+        Description:
+            acquire and parse the PH packets from the quabo.
+            The capture is cached by (npkt, hv_after_warmup), so the checks using the same acquisition
+            share one capture, instead of acquiring the same data again.
+        Inputs:
+            - npkt(int): the number of PH packets to receive.
+            - check(str): the name of the check, which is used in the error messages.
+            - hv_after_warmup(bool): turn on the high voltage after the quabo warms up, instead of
+                                     before configuring the MAROC chips. The HK packet destination is also set.
+        Outputs:
+            - ph(DataRecv): the DataRecv object holding the raw packets, None if it failed.
+            - M(np.ndarray): the PH data, one row for each packet, None if it failed.
+            - ts(np.ndarray): the timestamps of the PH packets, None if it failed.
+        """
+        key = (npkt, hv_after_warmup)
+        if key in self._ph_cache:
+            return self._ph_cache[key]
+        # config the quabo
+        qc = QuaboConfig(self.ip)
+        # set the PH packet destination
+        if hv_after_warmup:
+            qc.SetHkPacketDest()
+        macs = qc.SetDataPktDest()
+        if macs is None:
+            self.logger.error('Error: no MAC address received from the quabo')
+            self.logger.error('Error: %s check failed'%check)
+            return None, None, None
+        # turn on the high voltage
+        if not hv_after_warmup:
+            qc.SetHv('on')
+        # configure the MAROC parameters
+        qc.SetMarocParams()
+        # set the PH packet mode
+        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=True,bl_subtract=True)
+        qc.DaqParamsConfig(params)
+        # wait for a few seconds to let the quabo warm up,
+        # and drain the packets sent in the meantime, so the capture starts clean
+        ph = DataRecv(self.ip)
+        ph.DrainData(2)
+        if hv_after_warmup:
+            qc.SetHv('on')
+        ph.RecvData(npkt)
+        # turn off the high voltage and the PH packet mode
+        with qc.batched():
+            qc.SetHv('off')
+            params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=False,bl_subtract=True)
+            qc.DaqParamsConfig(params)
+        qc.close()
+        ph.close()
+        # parse the PH data
+        phpkt = ph.ParseData()
+        if phpkt is None or len(phpkt) == 0:
+            self.logger.error('Error: Failed to parse PH data, which is None or empty')
+            self.logger.error('Error: %s check failed'%check)
+            return None, None, None
+        self._ph_cache[key] = (ph,) + self._PHToSoA(phpkt)
+        return self._ph_cache[key]
     
     def _CheckPatternMatch(self, d, p):
         """
@@ -2432,16 +3164,54 @@ class SiPMSimTest(QuaboTest):
         Outputs:
             - bool: True if the data and pattern match, False otherwise.
         """
-        match = False
-        for i in range(len(p)):
-            if p[i] == d[0]:
-                for j in range(len(d)):
-                    k = (i + j)%len(p)
-                    if p[k] != d[j]:
-                        break
-                    elif j == len(d) - 1:
-                        match = True
-        return match
+        d = np.asarray(d)
+        p = np.asarray(p)
+        if len(d) == 0 or len(p) == 0:
+            return False
+        # only the rotations starting with the first data value can match
+        starts = np.flatnonzero(p == d[0])
+        if len(starts) == 0:
+            return False
+        # compare the data with these rotations of the pattern at once, one rotation in each row
+        idx = (starts[:, None] + np.arange(len(d))) % len(p)
+        return bool(np.any(np.all(p[idx] == d, axis=1)))
+
+    def _CheckPatternMatches(self, D, p):
+        """
+        Description:
+            Check if each row of the data matches to the pattern, the same as _CheckPatternMatch, but for all the rows at once.
+        Inputs:
+            - D(np.darray): the data to check, one round in each row.
+            - p(np.darray): the pattern to check.
+        Outputs:
+            - np.ndarray: True for the rows matching the pattern, False otherwise.
+        """
+        p = np.asarray(p)
+        if D.shape[1] == 0 or len(p) == 0:
+            return np.zeros(len(D), dtype=bool)
+        # all the rotations of the pattern, one rotation in each row
+        rotations = p[(np.arange(len(p))[:, None] + np.arange(D.shape[1])) % len(p)]
+        return np.all(D[:, None, :] == rotations, axis=2).any(axis=1)
+
+    @staticmethod
+    def _PHToSoA(phpkt):
+        """
+        Description:
+            convert the parsed PH packets into a 2-D data array and a timestamp array, so the per-packet
+            values can be computed for all the packets in one call.
+        Inputs:
+            - phpkt(list): the parsed PH packets.
+        Outputs:
+            - M(np.ndarray): the PH data, one row for each packet.
+            - ts(np.ndarray): the timestamps of the PH packets.
+        """
+        _, count, dtype = _DAQ_PAYLOAD['ph']
+        M = np.empty((len(phpkt), count), dtype=dtype)
+        ts = np.empty(len(phpkt), dtype=np.float64)
+        for i, d in enumerate(phpkt):
+            M[i] = d['data']
+            ts[i] = d['timestamp']
+        return M, ts
 
     def CheckPHPeaks(self):
         """
@@ -2456,50 +3226,15 @@ class SiPMSimTest(QuaboTest):
             return True
         e_val = self.expected_results['ph_npeak']['val']
         e_offset = self.expected_results['ph_npeak']['deviation']
-        # config the quabo
-        qc = QuaboConfig(self.ip)
-        # set the PH packet destination
-        macs = qc.SetDataPktDest()
-        if macs is None:
-            self.logger.error('Error: no MAC address received from the quabo')
-            self.logger.error('Error: PH peaks check failed')
-            return False
-        # turn on the high voltage
-        qc.SetHv('on')
-        # configure the MAROC parameters
-        qc.SetMarocParams()
-        # set the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=True,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        # wait for a few seconds to let the quabo warm up
-        time.sleep(2)
-        ph = DataRecv(self.ip)
-        ph.RecvData(self.autotest_config['NPhPeaks'])
-        # turn off the high voltage
-        qc.SetHv('off')
-        # turn off the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=False,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        qc.close()
-        ph.close()
-        # parse the PH data
-        phpkt = ph.ParseData()
-        if phpkt is None:
-            self.logger.error('Error: Failed to parse PH data, which is None')
-            self.logger.error('Error: PH peaks check failed')
+        ph, M, ts = self._AcquirePH(self.autotest_config['NPhPeaks'], 'PH peaks')
+        if M is None:
             return False
         # dump the data
         ph.DumpData('reports/%s/sipmsim/ph_peaks.npz'%self.uid)
         # check the PH data
-        npeaks = []
-        for d in phpkt:
-            n = 0
-            mean = np.mean(d['data'])
-            for i in range(len(d['data'])):
-                if d['data'][i] > self.autotest_config['PHThreshold'] + mean:
-                    n += 1
-            npeaks.append(n)
-        npeaks = np.array(npeaks)
+        # count the channels above the threshold(relative to the mean) in each packet
+        thr = self.autotest_config['PHThreshold']
+        npeaks = np.count_nonzero(M > M.mean(axis=1, keepdims=True) + thr, axis=1)
         passed = True
         # check the min peaks, which should be 1 at least
         if np.min(npeaks) < 1:
@@ -2526,48 +3261,19 @@ class SiPMSimTest(QuaboTest):
         self.logger.info('Checking Pulse Height')
         self.logger.info('------------------------------------')
         expected_results = self.expected_results['ph_data']
-        # config the quabo
-        qc = QuaboConfig(self.ip)
-        # set the PH packet destination
-        macs = qc.SetDataPktDest()
-        if macs is None:
-            self.logger.error('Error: no MAC address received from the quabo')
-            self.logger.error('Error: PH data check failed')
-            return False
-        # turn on the high voltage
-        qc.SetHv('on')
-        # configure the MAROC parameters
-        qc.SetMarocParams()
-        # set the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=True,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        # wait for a few seconds to let the quabo warm up
-        time.sleep(2)
-        ph = DataRecv(self.ip)
-        ph.RecvData(self.autotest_config['NPhPkt'])
-        # turn off the high voltage
-        qc.SetHv('off')
-        # turn off the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=False,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        qc.close()
-        ph.close()
-        phpkt = ph.ParseData()
-        if phpkt is None:
-            self.logger.error('Error: Failed to parse PH data, which is None')
-            self.logger.error('Error: PH data check failed')
+        ph, M, ts = self._AcquirePH(self.autotest_config['NPhPkt'], 'PH data')
+        if M is None:
             return False
         # dump the data
         ph.DumpData('reports/%s/sipmsim/ph_pulse_height.npz'%self.uid)
         # check the PH data
-        peaks = []
-        for d in phpkt:
-            peaks.append(max(d['data']))
-        peaks = np.array(peaks)
-        peaks_mean = np.mean(peaks)
-        peaks_std = np.std(peaks)
-        peaks_max = np.max(peaks)
-        peaks_min = np.min(peaks)
+        peaks = M.max(axis=1)
+        peaks_mean = peaks.mean()
+        # reuse the mean for the std, which is what np.std does internally(it works on all numpy versions)
+        dev = peaks - peaks_mean
+        peaks_std = np.sqrt(np.mean(dev * dev))
+        peaks_max = peaks.max()
+        peaks_min = peaks.min()
         actual_vals = {}
         actual_vals['mean_pulse_height'] = peaks_mean
         actual_vals['std_pulse_height'] = peaks_std
@@ -2591,46 +3297,19 @@ class SiPMSimTest(QuaboTest):
             return True
         e_val = self.expected_results['ph_pulse_rate']['val']
         e_offset = self.expected_results['ph_pulse_rate']['deviation']
-        # config the quabo
-        qc = QuaboConfig(self.ip)
-        # set the PH packet destination
-        macs = qc.SetDataPktDest()
-        if macs is None:
-            self.logger.error('Error: no MAC address received from the quabo')
-            self.logger.error('Error: PH timing check failed')
-            return False
-        # turn on the high voltage
-        qc.SetHv('on')
-        # configure the MAROC parameters
-        qc.SetMarocParams()
-        # set the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=True,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        # wait for a few seconds to let the quabo warm up
-        time.sleep(2)
-        ph = DataRecv(self.ip)
-        ph.RecvData(self.autotest_config['NPhPkt'])
-        # turn off the high voltage
-        qc.SetHv('off')
-        # turn off the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=False,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        qc.close()
-        ph.close()
-        phpkt = ph.ParseData()
-        if phpkt is None:
-            self.logger.error('Error: Failed to parse PH data, which is None')
-            self.logger.error('Error: PH timing check failed')
+        ph, M, ts = self._AcquirePH(self.autotest_config['NPhPkt'], 'PH timing')
+        if M is None:
             return False
         # dump the data
         ph.DumpData('reports/%s/sipmsim/ph_pulse_rate.npz'%self.uid)
-        # get the timestamp
-        timestamps = []
-        for d in phpkt:
-            timestamps.append(d['timestamp'])
-        timestamps = np.array(timestamps, dtype=np.float64)
-        timestamps_diff = np.diff(timestamps)
-        a_val = 1/np.mean(timestamps_diff)
+        # the mean of the timestamp differences is (last - first)/(n - 1)
+        if len(ts) < 2:
+            self.logger.error('Error: Pulse Rate - at least 2 PH packets are needed, but got %d'%len(ts))
+            return False
+        if ts[-1] <= ts[0]:
+            self.logger.error('Error: Pulse Rate - the PH packets have the same timestamp, the rate can not be computed')
+            return False
+        a_val = (len(ts) - 1)/(ts[-1] - ts[0])
         if abs(e_val) - e_offset > abs(a_val) or abs(e_val) + e_offset < abs(a_val):
             self.logger.error('Error: Pulse Rate - Expected val(%.02f)/deviation(%.02f) is not equal to %.02f'%(e_val, e_offset, a_val))
             return False
@@ -2657,46 +3336,13 @@ class SiPMSimTest(QuaboTest):
         e_pattern = self.expected_results['ph_pattern'][self.boardver][self.connector]
         # each pulse will generate 2 ph events
         e_pattern = np.repeat(e_pattern, 2)
-        # configure the quabo
-        qc = QuaboConfig(self.ip)
-        # set the PH packet destination
-        qc.SetHkPacketDest()
-        macs = qc.SetDataPktDest()
-        if macs is None:
-            self.logger.error('Error: no MAC address received from the quabo')
-            self.logger.error('Error: PH pattern check failed')
-            return False
-        # configure maroc chip
-        qc.SetMarocParams()
-        # set the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=True,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        # wait for a few seconds to let the quabo warm up
-        time.sleep(2)
-        # turn on the high voltage
-        qc.SetHv('on')
-        # get data
-        ph = DataRecv(self.ip)
-        ph.RecvData(self.autotest_config['NPhPkt'])
-        qc.SetHv('off')
-        # turn off the PH packet mode
-        params = DAQ_PARAMS(do_image=False, image_us=1000, image_8bit=False, do_ph=False,bl_subtract=True)
-        qc.DaqParamsConfig(params)
-        qc.close()
-        ph.close()
-        # parse the data
-        phpkt = ph.ParseData()
-        if phpkt is None:
-            self.logger.error('Error: Failed to parse PH data, which is None')
-            self.logger.error('Error: PH pattern check failed')
+        ph, M, ts = self._AcquirePH(self.autotest_config['NPhPkt'], 'PH pattern', hv_after_warmup=True)
+        if M is None:
             return False
         # dump the data
         ph.DumpData('reports/%s/sipmsim/ph_pattern_%s.npz'%(self.uid, self.connector))
         # get the pattern
-        ph_pattern = []
-        for d in phpkt:
-            ph_pattern.append(np.argmax(d['data']))
-        ph_pattern = np.array(ph_pattern)
+        ph_pattern = M.argmax(axis=1)
         # check the pattern
         # We will check it for 10 times
         # We get 10 * 64 samples for test
@@ -2705,20 +3351,26 @@ class SiPMSimTest(QuaboTest):
         # TODO: add more flexible way to check the pattern
         # TODO: we may not want to use the random numbers here
         NCheck = 10
-        NMactched = 0
-        for i in range(NCheck):
-            a_pattern = ph_pattern[i*68 + 16:i*68 + 16 + 64]
-            match = self._CheckPatternMatch(a_pattern, e_pattern)
+        NLen = 64
+        starts = np.arange(NCheck)*68 + 16
+        if len(ph_pattern) >= starts[-1] + NLen:
+            # check all the rounds at once
+            matched = self._CheckPatternMatches(ph_pattern[starts[:, None] + np.arange(NLen)], e_pattern)
+        else:
+            # there are not enough packets for all the rounds, so check the (partial) rounds one by one
+            matched = [self._CheckPatternMatch(ph_pattern[i:i + NLen], e_pattern) for i in starts]
+        for i, match in enumerate(matched):
             if match:
                 self.logger.info('Info: PH pattern match in %02d round check.'%i)
-                NMactched += 1
             else:
                 self.logger.error('Error: PH pattern not match in %02d round check.'%i)
+        NMactched = np.count_nonzero(matched)
+        a_pattern = ph_pattern[starts[-1]:starts[-1] + NLen]
         if NMactched == NCheck:
             self.logger.info('Info: PH pattern check is successfully.')
             return True
         else:
-            self.logger.debug('Expected Pattern: \n%s'%e_pattern)
-            self.logger.debug('Actual Pattern: \n%s'%a_pattern)
+            self.logger.debug('Expected Pattern: \n%s', e_pattern)
+            self.logger.debug('Actual Pattern: \n%s', a_pattern)
             self.logger.error('Error: PH pattern check failed.')
             return False
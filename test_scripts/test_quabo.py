@@ -1,11 +1,18 @@
 from QuaboAutoTest import *
 import pytest
 
-autotest = QuaboTest('configs/quabo_ip.json')
+@pytest.fixture(scope='module')
+def autotest():
+    """
+    Description:
+        Create the QuaboTest once for the tests in this module,
+        and only when one of them is selected.
+    """
+    return QuaboTest('configs/quabo_ip.json')
 
 @pytest.mark.all
 @pytest.mark.hk_vals
-def test_hk_vals():
+def test_hk_vals(autotest):
     """
     Description: 
         Check the HK values
@@ -15,7 +22,7 @@ def test_hk_vals():
 
 @pytest.mark.all
 @pytest.mark.hk_time
-def test_hk_time():
+def test_hk_time(autotest):
     """"
     Description: 
         Check the HK timestamp"
@@ -25,7 +32,7 @@ def test_hk_time():
 
 @pytest.mark.all
 @pytest.mark.maroc_config
-def test_maroc_config():
+def test_maroc_config(autotest):
     """"
     Description: 
         Check the MAROC config
@@ -35,7 +42,7 @@ def test_maroc_config():
 
 @pytest.mark.all
 @pytest.mark.wr_timing
-def test_wr_timing():
+def test_wr_timing(autotest):
     """
     Description:
         Check the WR timg.
@@ -1,14 +1,21 @@
 from QuaboAutoTest import *
 import pytest
 
-autotest_config = Util.read_json('configs/autotest_config.json')
-connector = autotest_config['SiPMsimulator']
-boardrev = autotest_config['BoardRev']
-autotest = SiPMSimTest(boardrev, connector, 'configs/quabo_ip.json')
+@pytest.fixture(scope='module')
+def autotest():
+    """
+    Description:
+        Create the SiPMSimTest once for the tests in this module,
+        and only when one of them is selected.
+    """
+    autotest_config = Util.read_json('configs/autotest_config.json')
+    connector = autotest_config['SiPMsimulator']
+    boardrev = autotest_config['BoardRev']
+    return SiPMSimTest(boardrev, connector, 'configs/quabo_ip.json')
 
 @pytest.mark.all
 @pytest.mark.mac
-def test_mac():
+def test_mac(autotest):
     """"
     Description: 
         Check the destination MAC address
@@ -19,7 +26,7 @@ def test_mac():
 @pytest.mark.all
 @pytest.mark.ph
 @pytest.mark.ph_peaks
-def test_ph_peaks():
+def test_ph_peaks(autotest):
     """"
     Description: 
         Check how many PH peaks are in the ph data.
@@ -30,7 +37,7 @@ def test_ph_peaks():
 @pytest.mark.all
 @pytest.mark.ph
 @pytest.mark.ph_pulse_height
-def test_ph_pulse_height():
+def test_ph_pulse_height(autotest):
     """"
     Description: 
         Check the pusle height of the PH data."
@@ -41,7 +48,7 @@ def test_ph_pulse_height():
 @pytest.mark.all
 @pytest.mark.ph
 @pytest.mark.ph_pulse_rate
-def test_ph_pulse_rate():
+def test_ph_pulse_rate(autotest):
     """"
     Description: 
         Check the pulse rate of the PH data."
@@ -52,7 +59,7 @@ def test_ph_pulse_rate():
 @pytest.mark.all
 @pytest.mark.ph
 @pytest.mark.ph_pattern
-def test_ph_pattern():
+def test_ph_pattern(autotest):
     """"
     Description: 
         Check the PH pattern
@@ -4,15 +4,96 @@
 from QuaboAutoTest import tftpw
 from QuaboAutoTest import Util
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
+import tftpy
+
+# The stages in the order they are run
+STAGES = ['gold', 'silver', 'wrpc', 'reboot']
+
+def file_digest(path):
+    """
+    Description:
+        compute the BLAKE2b digest of a file.
+    Inputs:
+        - path(str): the file path.
+    Outputs:
+        - digest(str): the hex digest.
+    """
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def flash_quabo(ip, tftp_client, uploads, todo, digests):
+    """
+    Description:
+        run the stages for one Quabo.
+    Inputs:
+        - ip(str): the IP address of the Quabo.
+        - tftp_client(tftpw): the tftp client of the Quabo.
+        - uploads(list): (stage, file, upload function) of the uploads to run.
+        - todo(list): the stages to run.
+        - digests(dict): the digests of the files, empty if the unchanged files are not skipped.
+    Outputs:
+        - bool: True if the Quabo is up and running at the end, False otherwise,
+                including when an upload fails.
+    """
+    # Check if the IP address is valid
+    status = Util.ping(ip)
+    if status:
+        print(f"Quabo is up and running at {ip}.")
+    else:
+        print(f"Error: Quabo is not reachable at {ip}.")
+        return False
+    # an error on one Quabo is reported here, so the results of the others are not lost
+    try:
+        # the digests of the files uploaded to this Quabo last time, which are keyed by the flash UID,
+        # because every board on the test jig takes the same IP address
+        manifest = {}
+        if digests:
+            uid = tftp_client.get_flashuid('logs/flashuid_%s'%ip)
+            manifest_file = 'logs/firmware_manifest_%s.json'%uid
+            if os.path.exists(manifest_file):
+                manifest = Util.read_json(manifest_file)
+        # Upload golden firmware, silver firmware and wrpc filesys
+        for name, path, upload in uploads:
+            if name in digests and manifest.get(name) == digests[name]:
+                print(f"{path} is not changed since the last upload to {ip}, skip the {name} stage.")
+                continue
+            print(f"Uploading {name} ({path}) to {ip}...")
+            upload(tftp_client)
+            print(f"{path} uploaded to {ip} successfully.")
+            if name in digests:
+                manifest[name] = digests[name]
+                Util.write_json(manifest_file, manifest)
+        # reboot the Quabo, and see if everything is ok
+        if 'reboot' in todo:
+            print(f"Rebooting the Quabo at {ip}...")
+            tftp_client.reboot()
+    except (tftpy.TftpException, OSError, ValueError) as e:
+        print(f"Error: failed to flash the Quabo at {ip}: {e}")
+        return False
+    # ping with a short timeout and more attempts(still 30s in total),
+    # so the quabo coming back is noticed within 0.2s instead of up to 1s
+    status = Util.ping(ip, loop=150, timeout=0.2)
+    if status:
+        print(f"Quabo is up and running at {ip}.")
+    else:
+        print(f"Error: Quabo is not reachable at {ip}.")
+        return False
+    return True
 
 if __name__ == "__main__":
     # Parse command line arguments
-    # Usage: python upload_firmware.py -i <ip> -g <gold> -s <silver> -w <wrpc>
+    # Usage: python upload_firmware.py -i <ip>[,<ip>...] -g <gold> -s <silver> -w <wrpc>
     parser = ArgumentParser(prog=os.path.basename(__file__))
     parser.add_argument('-i', '--ip', dest="ip", type=str, 
                         default='192.168.3.248',
-                        help='IP address of the Quabo. Default: 192.168.3.248')
+                        help='IP address of the Quabo, or comma-separated IP addresses of several Quabos, '
+                        'which are flashed in parallel. Default: 192.168.3.248')
     parser.add_argument('-g', '--gold', dest='gold', type=str, 
                         default='firmware/quabo_GOLD.bin',
                         help="golden firmware file to upload. Default: firmware/quabo_GOLD.bin")
@@ -26,51 +107,62 @@ if __name__ == "__main__":
                         default='gold',
                         help='Stage to start from. Default: gold. '
                         'The valid stages are: gold, silver, wrpc, reboot',)
+    parser.add_argument('--only', dest='only', type=str,
+                        default=None,
+                        help='Comma-separated stages to run, e.g. gold,wrpc. '
+                        'Default: all of the stages from --stage.')
+    parser.add_argument('--skip-unchanged', dest='skip_unchanged', action='store_true',
+                        default=False,
+                        help='Skip the uploads whose files are the same as the ones uploaded to this Quabo last time, '
+                        'which are recorded in logs/firmware_manifest_<flash uid>.json.')
+    parser.add_argument('-b', '--blksize', dest='blksize', type=int,
+                        default=0,
+                        help='TFTP block size for the uploads, e.g. %d, which falls back to 512 bytes '
+                        'if the Quabo ignores or rejects it. Default: 0, the default 512 bytes.'%tftpw.DOWNLOAD_BLKSIZE)
     opts = parser.parse_args()
-    # Check if the IP address is valid
-    status = Util.ping(opts.ip)
-    if status:
-        print(f"Quabo is up and running at {opts.ip}.")
-    else:
-        print(f"Error: Quabo is not reachable at {opts.ip}.")
+    if opts.stage not in STAGES:
+        print(f"Error: invalid stage {opts.stage}.")
         exit(1)
-    tftp_client = tftpw(opts.ip)
-    print('Quabo IP address:', opts.ip)
-    stage = opts.stage
-    # Upload golden firmware
-    if opts.gold and stage == 'gold':
-        print("Uploading golden firmware...")
-        if not os.path.exists(opts.gold):
-            print(f"Error: {opts.gold} does not exist.")
-            exit(1)
-        tftp_client.put_bin_file(opts.gold, 0)
-        stage = 'silver'
-        print("Golden firmware uploaded successfully.")
-    if opts.silver and stage == 'silver':
-        print("Uploading silver firmware...")
-        if not os.path.exists(opts.silver):
-            print(f"Error: {opts.silver} does not exist.")
+    todo = STAGES[STAGES.index(opts.stage):]
+    if opts.only:
+        only = [x.strip() for x in opts.only.split(',')]
+        for name in only:
+            if name not in STAGES:
+                print(f"Error: invalid stage {name}.")
+                exit(1)
+        todo = [name for name in todo if name in only]
+    ips = [ip.strip() for ip in opts.ip.split(',') if ip.strip()]
+    # the uploads, (stage, file, upload function)
+    uploads = [
+        ('gold', opts.gold, lambda client: client.put_bin_file(opts.gold, 0, blksize=opts.blksize)),
+        ('silver', opts.silver, lambda client: client.put_bin_file(opts.silver, blksize=opts.blksize)),
+        ('wrpc', opts.wrpc, lambda client: client.put_wrpc_filesys(opts.wrpc, blksize=opts.blksize)),
+    ]
+    uploads = [u for u in uploads if u[1] and u[0] in todo]
+    # Check the files of the stages to run once, before any network I/O,
+    # so a wrong path doesn't show up after the previous stages are uploaded
+    for name, path, upload in uploads:
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            print(f"Error: {path} does not exist or is empty.")
             exit(1)
-        tftp_client.put_bin_file(opts.silver)
-        stage = 'wrpc'
-        print("Silver firmware uploaded successfully.")
-    if opts.wrpc and stage == 'wrpc':
-        print("Uploading wrpc filesys...")
-        if not os.path.exists(opts.wrpc):
-            print(f"Error: {opts.wrpc} does not exist.")
+        # the size of wrpc filesys is fixed, and put_wrpc_filesys doesn't upload it otherwise
+        if name == 'wrpc' and os.path.getsize(path) != 0x110000:
+            print(f"Error: the size of {path} is incorrect, please check it!")
             exit(1)
-        tftp_client.put_wrpc_filesys(opts.wrpc)
-        stage = 'reboot'
-        print("Wrpc filesys uploaded successfully.")
-    # reboot the Quabo, and see if everything is ok
-    if stage == 'reboot':
-        print("Rebooting the Quabo...")
-        tftp_client.reboot()
-    status = Util.ping(opts.ip)
-    if status:
-        print(f"Quabo is up and running at {opts.ip}.")
-        stage = 'fwver'
+    # the digests of the files, which are computed once for all of the Quabos
+    digests = {}
+    if opts.skip_unchanged:
+        os.makedirs('logs', exist_ok=True)
+        digests = {name: file_digest(path) for name, path, upload in uploads}
+    # tftpw sets up the shared loggers once, when the first client is created
+    clients = [tftpw(ip) for ip in ips]
+    if len(ips) == 1:
+        results = [flash_quabo(ips[0], clients[0], uploads, todo, digests)]
     else:
-        print(f"Error: Quabo is not reachable at {opts.ip}.")
+        # each Quabo has its own flash chip and TFTP server, so they are flashed in parallel
+        with ThreadPoolExecutor(max_workers=len(ips)) as pool:
+            results = list(pool.map(flash_quabo, ips, clients, [uploads]*len(ips), [todo]*len(ips),
+                                    [digests]*len(ips)))
+    if not all(results):
         exit(1)
-    print('Done.')
\ No newline at end of file
+    print('Done.')